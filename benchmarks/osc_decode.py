@@ -0,0 +1,221 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Micro-benchmark of the OSC decoder of nsmclient against the decoder it replaced.
+
+    python3 benchmarks/osc_decode.py
+
+The old _IncomingMessage is kept below, verbatim, as the reference.
+"""
+
+import logging
+import struct
+import timeit
+import os.path
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import nsmclient
+
+logger = logging.getLogger("bench")
+nsmclient.logger = logger
+
+class _LegacyIncomingMessage(object):
+    """Representation of a parsed datagram representing an OSC message.
+
+    An OSC message consists of an OSC Address Pattern followed by an OSC
+    Type Tag String followed by zero or more OSC Arguments.
+    """
+
+    def __init__(self, dgram):
+        #NSM Broadcasts are bundles, but very simple ones. We only need to care about the single message it contains.
+        #Therefore we can strip the bundle prefix and handle it as normal message.
+        if b"#bundle" in dgram:
+            bundlePrefix, singleMessage = dgram.split(b"/", maxsplit=1)
+            dgram = b"/" + singleMessage  # / eaten by split
+            self.isBroadcast = True
+        else:
+            self.isBroadcast = False
+        self.LENGTH = 4 #32 bit
+        self._dgram = dgram
+        self._parameters = []
+        self.parse_datagram()
+
+
+    def get_int(self, dgram, start_index):
+        """Get a 32-bit big-endian two's complement integer from the datagram.
+
+        Args:
+        dgram: A datagram packet.
+        start_index: An index where the integer starts in the datagram.
+
+        Returns:
+        A tuple containing the integer and the new end index.
+
+        Raises:
+        ValueError if the datagram could not be parsed.
+        """
+        try:
+            if len(dgram[start_index:]) < self.LENGTH:
+                raise ValueError('Datagram is too short')
+            return (
+                struct.unpack('>i', dgram[start_index:start_index + self.LENGTH])[0], start_index + self.LENGTH)
+        except (struct.error, TypeError) as e:
+            raise ValueError('Could not parse datagram %s' % e)
+
+    def get_string(self, dgram, start_index):
+        """Get a python string from the datagram, starting at pos start_index.
+
+        We receive always the full string, but handle only the part from the start_index internally.
+        In the end return the offset so it can be added to the index for the next parameter.
+        Each subsequent call handles less of the same string, starting further to the right.
+
+        According to the specifications, a string is:
+        "A sequence of non-null ASCII characters followed by a null,
+        followed by 0-3 additional null characters to make the total number
+        of bits a multiple of 32".
+
+        Args:
+        dgram: A datagram packet.
+        start_index: An index where the string starts in the datagram.
+
+        Returns:
+        A tuple containing the string and the new end index.
+
+        Raises:
+        ValueError if the datagram could not be parsed.
+        """
+        #First test for empty string, which is nothing, followed by a terminating \x00 padded by three additional \x00.
+        if dgram[start_index:].startswith(b"\x00\x00\x00\x00"):
+            return "", start_index + 4
+
+        #Otherwise we have a non-empty string that must follow the rules of the docstring.
+
+        offset = 0
+        try:
+            while dgram[start_index + offset] != 0:
+                offset += 1
+            if offset == 0:
+                raise ValueError('OSC string cannot begin with a null byte: %s' % dgram[start_index:])
+            # Align to a byte word.
+            if (offset) % self.LENGTH == 0:
+                offset += self.LENGTH
+            else:
+                offset += (-offset % self.LENGTH)
+            # Python slices do not raise an IndexError past the last index,
+                # do it ourselves.
+            if offset > len(dgram[start_index:]):
+                raise ValueError('Datagram is too short')
+            data_str = dgram[start_index:start_index + offset]
+            return data_str.replace(b'\x00', b'').decode('utf-8'), start_index + offset
+        except IndexError as ie:
+            raise ValueError('Could not parse datagram %s' % ie)
+        except TypeError as te:
+            raise ValueError('Could not parse datagram %s' % te)
+
+    def get_float(self, dgram, start_index):
+        """Get a 32-bit big-endian IEEE 754 floating point number from the datagram.
+
+          Args:
+            dgram: A datagram packet.
+            start_index: An index where the float starts in the datagram.
+
+          Returns:
+            A tuple containing the float and the new end index.
+
+          Raises:
+            ValueError if the datagram could not be parsed.
+        """
+        try:
+            return (struct.unpack('>f', dgram[start_index:start_index + self.LENGTH])[0], start_index + self.LENGTH)
+        except (struct.error, TypeError) as e:
+            raise ValueError('Could not parse datagram %s' % e)
+
+    def parse_datagram(self):
+        try:
+            self._address_regexp, index = self.get_string(self._dgram, 0)
+            if not self._dgram[index:]:
+                # No params is legit, just return now.
+                return
+
+            # Get the parameters types.
+            type_tag, index = self.get_string(self._dgram, index)
+            if type_tag.startswith(','):
+                type_tag = type_tag[1:]
+
+            # Parse each parameter given its type.
+            for param in type_tag:
+                if param == "i":  # Integer.
+                    val, index = self.get_int(self._dgram, index)
+                elif param == "f":  # Float.
+                    val, index = self.get_float(self._dgram, index)
+                elif param == "s":  # String.
+                    val, index = self.get_string(self._dgram, index)
+                else:
+                    logger.warning("Unhandled parameter type: {0}".format(param))
+                    continue
+                self._parameters.append(val)
+        except ValueError as pe:
+            #raise ValueError('Found incorrect datagram, ignoring it', pe)
+            # Raising an error is not ignoring it!
+            logger.warning("Found incorrect datagram, ignoring it. {}".format(pe))
+
+    @property
+    def oscpath(self):
+        """Returns the OSC address regular expression."""
+        return self._address_regexp
+
+    @staticmethod
+    def dgram_is_message(dgram):
+        """Returns whether this datagram starts as an OSC message."""
+        return dgram.startswith(b'/')
+
+    @property
+    def size(self):
+        """Returns the length of the datagram for this message."""
+        return len(self._dgram)
+
+    @property
+    def dgram(self):
+        """Returns the datagram from which this message was built."""
+        return self._dgram
+
+    @property
+    def params(self):
+        """Convenience method for list(self) to get the list of parameters."""
+        return list(self)
+
+    def __iter__(self):
+        """Returns an iterator over the parameters of this message."""
+        return iter(self._parameters)
+
+
+def _string(value):
+    data = value.encode("utf-8")
+    return data + b"\x00" * (4 - len(data) % 4)
+
+def _message(path, *args):
+    tags = "".join({str: "s", int: "i", float: "f"}[type(arg)] for arg in args)
+    data = b"".join(_string(arg) if isinstance(arg, str) else struct.pack(">" + {int: "i", float: "f"}[type(arg)], arg) for arg in args)
+    return _string(path) + _string("," + tags) + data
+
+CASES = {
+    "nsm open": _message("/nsm/client/open", "/home/user/NSM Sessions/live/5FX-Patcher.nXYZA", "live", "5FX-Patcher.nXYZA"),
+    "reply": _message("/reply", "/nsm/server/open", "Loaded."),
+    "4 KiB string": _message("/sfx/text", "x" * 4096),
+    "32 args": _message("/sfx/params", *[float(i) for i in range(16)], *[i for i in range(16)]),
+}
+
+def bench(cls, dgram, number):
+    def decode():
+        cls(dgram).params
+    return min(timeit.repeat(decode, number=number, repeat=5)) / number
+
+if __name__ == "__main__":
+    number = 2000
+    print("{:<14} {:>12} {:>12} {:>8}".format("case", "legacy (us)", "new (us)", "speedup"))
+    for name, dgram in CASES.items():
+        assert _LegacyIncomingMessage(dgram).params == nsmclient._IncomingMessage(dgram).params, name
+        legacy = bench(_LegacyIncomingMessage, dgram, number)
+        new = bench(nsmclient._IncomingMessage, dgram, number)
+        print("{:<14} {:>12.2f} {:>12.2f} {:>7.1f}x".format(name, legacy * 1e6, new * 1e6, legacy / new))
@@ -1,79 +1,1081 @@
 #!/usr/bin/env python3
 
 import subprocess as sp
+import ctypes.util
+import socketserver
+import collections
+import selectors
 import argparse
+import difflib
+import signal
+import ctypes
+import json
+import time
 import sys
+import ast
+import os
+import re
 
-if __name__ == "__main__" :
+import sfxmetrics
 
-  parser = argparse.ArgumentParser(description="Jackpatch utility reworked for finer usage")
-  parser.add_argument('--save', action='store_true', help='dump current patchbay to stdout')
-  parser.add_argument('--load', action='store_true', help='load a patchbay from stdin')
-  parser.add_argument('--clear', action='store_true', help='Clear all connections')
+PatchFormat = "jack-patch"
+PatchVersion = 2
 
-  args = parser.parse_args()
-  
+class LibJack :
+  """ Single persistent JACK client session, bound to libjack through ctypes """
 
-  if args.save :
+  NoStartServer = 0x01
+  PortIsInput = 0x1
+  PortIsOutput = 0x2
+  EEXIST = 17
 
-    raw = sp.run(["jack_lsp", "-c", "-A"], stdout=sp.PIPE).stdout.decode().split('\n')
-    
-    ports_by_aliases = dict()
-    aliases_by_ports = dict()
-    connections = list()
+  RegistrationCallback = ctypes.CFUNCTYPE(None, ctypes.c_uint32, ctypes.c_int, ctypes.c_void_p)
+  ConnectCallback = ctypes.CFUNCTYPE(None, ctypes.c_uint32, ctypes.c_uint32, ctypes.c_int, ctypes.c_void_p)
+  RenameCallback = ctypes.CFUNCTYPE(None, ctypes.c_uint32, ctypes.c_char_p, ctypes.c_char_p, ctypes.c_void_p)
+  ShutdownCallback = ctypes.CFUNCTYPE(None, ctypes.c_void_p)
 
-    current_port = None
-    status = 0 # 0 : new port   1 : alias   2 : connections
-  
-    for line in raw :
-      if 0 == len(line) :
-        continue
+  def __init__(self, name = "jack-patch") :
+    path = ctypes.util.find_library('jack')
+    if path is None :
+      raise OSError("libjack not found")
+
+    lib = ctypes.CDLL(path)
+    lib.jack_client_open.restype = ctypes.c_void_p
+    lib.jack_client_open.argtypes = [ctypes.c_char_p, ctypes.c_int, ctypes.POINTER(ctypes.c_int)]
+    lib.jack_client_close.argtypes = [ctypes.c_void_p]
+    lib.jack_connect.argtypes = [ctypes.c_void_p, ctypes.c_char_p, ctypes.c_char_p]
+    lib.jack_disconnect.argtypes = [ctypes.c_void_p, ctypes.c_char_p, ctypes.c_char_p]
+    lib.jack_port_by_name.restype = ctypes.c_void_p
+    lib.jack_port_by_name.argtypes = [ctypes.c_void_p, ctypes.c_char_p]
+    lib.jack_port_flags.argtypes = [ctypes.c_void_p]
+    lib.jack_port_by_id.restype = ctypes.c_void_p
+    lib.jack_port_by_id.argtypes = [ctypes.c_void_p, ctypes.c_uint32]
+    lib.jack_port_name.restype = ctypes.c_char_p
+    lib.jack_port_name.argtypes = [ctypes.c_void_p]
+    lib.jack_port_get_aliases.argtypes = [ctypes.c_void_p, ctypes.POINTER(ctypes.c_char_p)]
+    lib.jack_get_ports.restype = ctypes.c_void_p
+    lib.jack_get_ports.argtypes = [ctypes.c_void_p, ctypes.c_char_p, ctypes.c_char_p, ctypes.c_ulong]
+    lib.jack_port_get_all_connections.restype = ctypes.c_void_p
+    lib.jack_port_get_all_connections.argtypes = [ctypes.c_void_p, ctypes.c_void_p]
+    lib.jack_free.argtypes = [ctypes.c_void_p]
+    lib.jack_activate.argtypes = [ctypes.c_void_p]
+    lib.jack_set_port_registration_callback.argtypes = [ctypes.c_void_p, self.RegistrationCallback, ctypes.c_void_p]
+    lib.jack_set_port_connect_callback.argtypes = [ctypes.c_void_p, self.ConnectCallback, ctypes.c_void_p]
+    lib.jack_on_shutdown.argtypes = [ctypes.c_void_p, self.ShutdownCallback, ctypes.c_void_p]
+    self.lib = lib
+    self.callbacks = list() # keeps ctypes trampolines alive
+    self.name_size = lib.jack_port_name_size()
+
+    status = ctypes.c_int()
+    self.client = lib.jack_client_open(name.encode(), self.NoStartServer, ctypes.byref(status))
+    if not self.client :
+      raise OSError(f"cannot open JACK client (status 0x{status.value:x})")
 
-      if ' ' == line[0] :
-        port = line.split()[0]
+  def orient(self, a, b) :
+    """ Returns the edge as (output, input), like jack_connect does """
+    port = self.lib.jack_port_by_name(self.client, a.encode())
+    if port is None :
+      raise KeyError(a)
+    if self.lib.jack_port_by_name(self.client, b.encode()) is None :
+      raise KeyError(b)
+    if self.lib.jack_port_flags(port) & self.PortIsInput :
+      return b.encode(), a.encode()
+    return a.encode(), b.encode()
 
-        if 0 == status :
-          status = 1
-          ports_by_aliases[port] = current_port
-          aliases_by_ports[current_port] = port
+  def connect(self, a, b) :
+    try :
+      src, dest = self.orient(a, b)
+    except KeyError as e :
+      return f"no such port {e}"
+    err = self.lib.jack_connect(self.client, src, dest)
+    if 0 != err and self.EEXIST != err :
+      return f"jack_connect failed ({err})"
+    return None
 
-        elif 1 == status :
-          connections.append((current_port, port))
+  def disconnect(self, a, b) :
+    try :
+      src, dest = self.orient(a, b)
+    except KeyError as e :
+      return f"no such port {e}"
+    err = self.lib.jack_disconnect(self.client, src, dest)
+    if 0 != err :
+      return f"jack_disconnect failed ({err})"
+    return None
 
+  def names(self, array) :
+    """ Reads then frees a NULL terminated array of names returned by JACK """
+    if not array :
+      return []
+    names = list()
+    entries = ctypes.cast(array, ctypes.POINTER(ctypes.c_char_p))
+    i = 0
+    while entries[i] is not None :
+      names.append(entries[i].decode())
+      i += 1
+    self.lib.jack_free(array)
+    return names
+
+  def aliases(self, port) :
+    buffers = [ctypes.create_string_buffer(self.name_size) for i in range(2)]
+    array = (ctypes.c_char_p * 2)(*[ctypes.addressof(b) for b in buffers])
+    count = self.lib.jack_port_get_aliases(port, array)
+    return [buffers[i].value.decode() for i in range(max(count, 0))]
+
+  def describe(self, port) :
+    """ Returns (name, aliases, is_output) of a port handle """
+    return (self.lib.jack_port_name(port).decode(), self.aliases(port),
+      bool(self.lib.jack_port_flags(port) & self.PortIsOutput))
+
+  def scan(self) :
+    """ Builds the graph straight from the server, without running jack_lsp """
+    graph = Graph()
+    ports = self.names(self.lib.jack_get_ports(self.client, None, None, 0))
+    for name in ports :
+      port = self.lib.jack_port_by_name(self.client, name.encode())
+      if port is not None :
+        graph.register(*self.describe(port))
+    for name in ports :
+      port = self.lib.jack_port_by_name(self.client, name.encode())
+      if port is not None :
+        for other in self.names(self.lib.jack_port_get_all_connections(self.client, port)) :
+          graph.connect(name, other)
+    return graph
+
+  def watch(self, post, shutdown) :
+    """ Activates the client, posting graph events as they are notified
+
+    Events are tuples naming a Graph method followed by its arguments. They
+    are posted from JACK's notification thread, post must not block. """
+
+    def on_registration(port_id, register, arg) :
+      port = self.lib.jack_port_by_id(self.client, port_id)
+      if port is None :
+        return
+      name, aliases, output = self.describe(port)
+      if register :
+        post(('register', name, aliases, output))
       else :
-        status = 0
-        current_port = line
+        post(('remove_port', name))
+
+    def on_connect(a, b, connect, arg) :
+      ports = [self.lib.jack_port_by_id(self.client, port_id) for port_id in (a, b)]
+      if None in ports :
+        return
+      names = [self.lib.jack_port_name(port).decode() for port in ports]
+      post(('connect' if connect else 'disconnect', *names))
+
+    def on_rename(port_id, old, new, arg) :
+      post(('rename', old.decode(), new.decode()))
+
+    def on_shutdown(arg) :
+      shutdown()
+
+    registration = self.RegistrationCallback(on_registration)
+    connection = self.ConnectCallback(on_connect)
+    shutdown_cb = self.ShutdownCallback(on_shutdown)
+    self.callbacks += [registration, connection, shutdown_cb]
 
-    print({
-      'ports' : list(ports_by_aliases.keys()),
-      'graph' : [(aliases_by_ports[src], aliases_by_ports[dest]) for src, dest in connections]
-    })
-  
-  if args.load :
+    self.lib.jack_set_port_registration_callback(self.client, registration, None)
+    self.lib.jack_set_port_connect_callback(self.client, connection, None)
+    self.lib.jack_on_shutdown(self.client, shutdown_cb, None)
+    if hasattr(self.lib, 'jack_set_port_rename_callback') : # not in every JACK version
+      rename = self.RenameCallback(on_rename)
+      self.callbacks.append(rename)
+      self.lib.jack_set_port_rename_callback.argtypes = [ctypes.c_void_p, self.RenameCallback, ctypes.c_void_p]
+      self.lib.jack_set_port_rename_callback(self.client, rename, None)
 
-    blob = sys.stdin.readlines()
-    
-    raw = eval("\n".join(blob)) # Prevent clearing the graph if load failed
+    if 0 != self.lib.jack_activate(self.client) :
+      raise OSError("cannot activate JACK client")
+
+  def close(self) :
+    if self.client :
+      self.lib.jack_client_close(self.client)
+      self.client = None
+
+class Watcher :
+  """ Always current Graph, kept in sync from JACK notifications
+
+  Callbacks only queue events, they are applied by the thread asking for the
+  graph. Notifications sent while the initial scan runs are applied on top of
+  it, which is harmless as every Graph update is idempotent. Aliases have no
+  notification, they are read again when the graph is saved. """
+
+  def __init__(self, jack, wake = None) :
+    self.jack = jack
+    self.events = collections.deque()
+    self.registered = list()
+    self.alive = True
+    self.wake = wake or (lambda : None)
+    jack.watch(self.post, self.shutdown)
+    self.model = jack.scan()
+
+  def post(self, event) :
+    self.events.append(event)
+    self.wake()
+
+  def shutdown(self) :
+    self.alive = False
+    self.wake()
+
+  def graph(self) :
+    if not self.alive :
+      raise OSError("JACK server has shut down")
+    while self.events :
+      event, *values = self.events.popleft()
+      getattr(self.model, event)(*values)
+      if 'register' == event :
+        self.registered.append(values[0])
+      elif 'rename' == event :
+        self.registered.append(values[1])
+    return self.model
+
+  def take_registered(self) :
+    """ Returns the ports registered since the last call """
+    registered, self.registered = self.registered, list()
+    return registered
+
+  def refresh_aliases(self) :
+    for name in list(self.model.ports) :
+      port = self.jack.lib.jack_port_by_name(self.jack.client, name.encode())
+      if port is not None :
+        self.model.set_aliases(name, self.jack.aliases(port))
+
+class JackTools :
+  """ Fallback backend spawning jack_connect / jack_disconnect for each edge """
+
+  def run(self, tool, a, b) :
+    res = sp.run([tool, a, b], stdout=sp.DEVNULL, stderr=sp.PIPE)
+    if 0 != res.returncode :
+      return res.stderr.decode().strip() or f"{tool} failed ({res.returncode})"
+    return None
+
+  def connect(self, a, b) :
+    return self.run('jack_connect', a, b)
+
+  def disconnect(self, a, b) :
+    return self.run('jack_disconnect', a, b)
+
+  def close(self) :
+    pass
+
+def open_backend() :
+  """ Opens a libjack session, or falls back on the jack_* command line tools """
+  try :
+    return LibJack()
+  except OSError as e :
+    print(f"jack-patch: {e}, falling back on jack tools", file=sys.stderr)
+    return JackTools()
+
+class Report :
+  """ Per-edge timing and failures of a batch of connections
+
+  Edges are also recorded into metrics, if given, as connect and disconnect
+  operations, so that they add up across batches. """
+
+  def __init__(self, verbose = False, metrics = None) :
+    self.verbose = verbose
+    self.metrics = metrics
+    self.edges = list() # (action, src, dest, seconds, error)
+
+  def add(self, action, src, dest, seconds, error) :
+    self.edges.append((action, src, dest, seconds, error))
+    if self.metrics is not None :
+      self.metrics.operation(action, seconds, error is not None)
+    if self.verbose :
+      print(f"jack-patch: {action} {src} -> {dest} : {seconds * 1000:.2f}ms", file=sys.stderr)
+    if error is not None :
+      print(f"jack-patch: {action} {src} -> {dest} failed : {error}", file=sys.stderr)
+
+  def defer(self, src, dest, missing) :
+    self.edges.append(('defer', src, dest, 0, None))
+    if self.verbose :
+      print(f"jack-patch: {src} -> {dest} waits for {', '.join(missing)}", file=sys.stderr)
+
+  def totals(self) :
+    lines = list()
+    for action in ('disconnect', 'connect') :
+      done = [e for e in self.edges if e[0] == action]
+      if 0 == len(done) :
+        continue
+      failed = sum(1 for e in done if e[4] is not None)
+      total = sum(e[3] for e in done)
+      lines.append(f"{action} {len(done)} edges in {total * 1000:.1f}ms, {failed} failed")
+    deferred = sum(1 for e in self.edges if 'defer' == e[0])
+    if 0 < deferred :
+      lines.append(f"{deferred} edges waiting for their ports")
+    return lines
 
-  if args.clear :
-  
-    old = sp.run(["jack_lsp", "-c"], stdout=sp.PIPE).stdout.decode().split('\n')
+  def summary(self) :
+    for line in self.totals() :
+      print(f"jack-patch: {line}", file=sys.stderr)
 
+class Graph :
+  """ Ports, aliases and connections of a JACK graph
+
+  ports maps each port to its aliases, names maps every port name and alias
+  back to its port, adjacency maps each port to the set of ports it is
+  connected to. Edges are stored once per end, as JACK reports them. """
+
+  def __init__(self) :
+    self.ports = dict()
+    self.names = dict()
+    self.adjacency = dict()
+    self.outputs = set()
+    self.inputs = set()
+    self.version = 0 # bumped whenever ports or names change
+
+  def add_port(self, port) :
+    if port in self.ports :
+      return
+    alias_of = self.names.get(port)
+    if alias_of is not None :
+      self.ports[alias_of].remove(port)
+    self.ports[port] = list()
+    self.names[port] = port
+    self.adjacency[port] = set()
+    self.version += 1
+
+  def remove_port(self, port) :
+    self.version += 1
+    for alias in self.ports.pop(port, ()) :
+      del self.names[alias]
+    self.names.pop(port, None)
+    for other in self.adjacency.pop(port, ()) :
+      self.adjacency[other].discard(port)
+    self.outputs.discard(port)
+    self.inputs.discard(port)
+
+  def add_alias(self, port, alias) :
+    if alias not in self.names :
+      self.ports[port].append(alias)
+      self.names[alias] = port
+      self.version += 1
+
+  def set_aliases(self, port, aliases) :
+    self.version += 1
+    for alias in self.ports.get(port, ()) :
+      del self.names[alias]
+    self.ports[port] = list()
+    for alias in aliases :
+      self.add_alias(port, alias)
+
+  def register(self, port, aliases, output) :
+    """ Adds a port reported by JACK, along with its aliases and direction """
+    self.add_port(port)
+    self.set_aliases(port, aliases)
+    (self.outputs if output else self.inputs).add(port)
+
+  def rename(self, old, new) :
+    if old not in self.ports or new in self.ports :
+      return
+    self.version += 1
+    self.ports[new] = self.ports.pop(old)
+    for alias in self.ports[new] :
+      self.names[alias] = new
+    del self.names[old]
+    self.names[new] = new
+    self.adjacency[new] = self.adjacency.pop(old)
+    for other in self.adjacency[new] :
+      self.adjacency[other].discard(old)
+      self.adjacency[other].add(new)
+    for direction in (self.outputs, self.inputs) :
+      if old in direction :
+        direction.discard(old)
+        direction.add(new)
+
+  def connect(self, a, b) :
+    if a in self.adjacency and b in self.adjacency :
+      self.adjacency[a].add(b)
+      self.adjacency[b].add(a)
+
+  def disconnect(self, a, b) :
+    if a in self.adjacency and b in self.adjacency :
+      self.adjacency[a].discard(b)
+      self.adjacency[b].discard(a)
+
+  def resolve(self, name) :
+    """ Returns the port named or aliased by name, None if unknown """
+    return self.names.get(name)
+
+  def label(self, port) :
+    """ Name under which a port is saved : its first alias, else its name """
+    aliases = self.ports[port]
+    return aliases[0] if aliases else port
+
+  def connections(self, name) :
+    port = self.resolve(name)
+    if port is None :
+      return []
+    return sorted(self.adjacency[port])
+
+  def edges(self) :
+    """ Yields each connection once, as (output, input) when known """
+    for port, others in self.adjacency.items() :
+      for other in others :
+        if port in self.outputs or other in self.inputs :
+          yield port, other
+        elif port not in self.inputs and other not in self.outputs and port < other :
+          yield port, other
+
+  def diff(self, target, resolve = None) :
+    """ Returns the (connect, disconnect) edge lists turning this graph into target
+
+    resolve(name, output) maps patch names to ports, exact names by default.
+    Edges to connect are given by port when resolved, by patch name if not. """
+    resolve = resolve or (lambda name, output : self.resolve(name))
+    wanted = dict()
+    for src, dest in target :
+      a = resolve(src, True) or src
+      b = resolve(dest, False) or dest
+      wanted.setdefault(frozenset((a, b)), (a, b))
+
+    connect = [(a, b) for a, b in wanted.values() if b not in self.adjacency.get(a, ())]
+    disconnect = [edge for edge in self.edges() if frozenset(edge) not in wanted]
+    return connect, disconnect
+
+  def save(self, stream) :
+    write_patch(stream, ([port] + self.ports[port] for port in self.ports),
+      ((self.label(src), self.label(dest)) for src, dest in self.edges()))
+
+  def parse(self, lines) :
+    """ Reads the output of jack_lsp -c -A -p, one line at a time
+
+    Aliases and connections are both printed as indented names. An indented
+    name is taken as a connection if that port is already known, as an alias
+    otherwise : connections are listed on both ends, so one printed before
+    its port is seen again once that port shows up, and the bogus alias is
+    then dropped by add_port. """
     current_port = None
-  
-    for line in old :
+
+    for line in lines :
+      line = line.rstrip('\n')
       if 0 == len(line) :
         continue
 
-      if ' ' == line[0] :
-        port = line.split()[0]
-        sp.run(['jack_disconnect', current_port, port])
+      if '\t' == line[0] :
+        properties = [p.strip() for p in line.split(':', 1)[-1].split(',')]
+        if 'output' in properties :
+          self.outputs.add(current_port)
+        elif 'input' in properties :
+          self.inputs.add(current_port)
+
+      elif ' ' == line[0] :
+        name = line.strip()
+        if name in self.ports :
+          self.connect(current_port, name)
+        else :
+          self.add_alias(current_port, name)
 
       else :
         current_port = line
+        self.add_port(current_port)
+
+    return self
+
+  @classmethod
+  def scan(cls) :
+    """ Builds the graph of the running JACK server with a single jack_lsp call """
+    with sp.Popen(["jack_lsp", "-c", "-A", "-p"], stdout=sp.PIPE, text=True) as lsp :
+      return cls().parse(lsp.stdout)
+
+HardwareNumbers = [
+  (re.compile(r'hw:\d+'), 'hw:#'),    # alsa_pcm:hw:1,0:out1
+  (re.compile(r'hw-\d+-'), 'hw-#-'),  # in-hw-1-0-0-UMC204HD-192k-MIDI-1
+  (re.compile(r'\[\d+\]'), '[#]'),    # a2j:UMC204HD 192k [20] (capture)
+]
+
+HardwarePort = re.compile(r'hw[:-]|alsa|\[#\]')
+
+def normalize(name) :
+  """ Port identity surviving ALSA renumbering : card and client numbers are masked """
+  name = name.lower()
+  for pattern, mask in HardwareNumbers :
+    name = pattern.sub(mask, name)
+  return name
+
+def split_port(name) :
+  """ Splits a normalized name into (device, port) on its last ':' or '-' """
+  cut = max(name.rfind(':'), name.rfind('-'))
+  return name[:cut], name[cut + 1:]
+
+class PortIndex :
+  """ Resolves patch names to the ports of a graph
+
+  Names are looked up, in order : as a port name or alias of the graph, as
+  any other name the patch saved for the same port, by normalized identity,
+  then for hardware ports only, by fuzzy matching of the device part among
+  ports of the same direction with the same port part. Derived indexes are
+  built once per graph version, fuzzy matches are cached. """
+
+  FuzzyCutoff = 0.6
+
+  def __init__(self, graph) :
+    self.graph = graph
+    self.saved = dict() # patch name -> every name the patch has for that port
+    self.version = None
+
+  def add_saved(self, names) :
+    for name in names :
+      self.saved[name] = names
+
+  def refresh(self) :
+    if self.version == self.graph.version :
+      return
+    self.normalized = dict() # normalized name -> set of ports
+    self.devices = dict()    # (direction, port part) -> {normalized device : port}
+    for name, port in self.graph.names.items() :
+      key = normalize(name)
+      self.normalized.setdefault(key, set()).add(port)
+      device, part = split_port(key)
+      self.devices.setdefault((port in self.graph.outputs, part), dict()).setdefault(device, port)
+    self.known_devices = {split_port(key)[0] for key in self.normalized}
+    self.fuzzy = dict()
+    self.version = self.graph.version
+
+  def resolve(self, name, output = None) :
+    """ Returns the port of the graph matching name, None if there is none
+
+    output tells which direction the port should have, None if unknown. """
+    port = self.graph.resolve(name)
+    if port is not None :
+      return port
+
+    names = self.saved.get(name, (name,))
+    for other in names :
+      port = self.graph.resolve(other)
+      if port is not None :
+        return port
+
+    self.refresh()
+    for other in names :
+      ports = self.normalized.get(normalize(other), ())
+      if 1 < len(ports) and output is not None :
+        ports = [port for port in ports if (port in self.graph.outputs) == output]
+      if 1 == len(ports) :
+        return next(iter(ports))
+
+    if output is None :
+      return None
+    for other in names :
+      port = self.match(normalize(other), output)
+      if port is not None :
+        return port
+    return None
+
+  def match(self, key, output) :
+    """ Fuzzy match of a renamed hardware device """
+    if HardwarePort.search(key) is None :
+      return None
+    if (key, output) not in self.fuzzy :
+      device, part = split_port(key)
+      port = None
+      if device not in self.known_devices : # device still here, the port is just missing
+        candidates = self.devices.get((output, part), {})
+        best = difflib.get_close_matches(device, candidates, n=1, cutoff=self.FuzzyCutoff)
+        if best :
+          port = candidates[best[0]]
+      self.fuzzy[(key, output)] = port
+    return self.fuzzy[(key, output)]
+
+class PatchError(ValueError) :
+  """ Raised when a patch file cannot be read """
+
+def write_patch(stream, ports, edges) :
+  """ Writes a patch : a header line, then one JSON value per line
+
+  A string is a port, a {"port": name, "aliases": [...]} object a port
+  along with its aliases, a [src, dest] pair an edge. ports yields the list
+  of names of each port, its name first. """
+  stream.write(json.dumps({'format' : PatchFormat, 'version' : PatchVersion}) + '\n')
+  for name, *aliases in ports :
+    stream.write(json.dumps({'port' : name, 'aliases' : aliases} if aliases else name) + '\n')
+  for src, dest in edges :
+    stream.write(json.dumps([src, dest]) + '\n')
+
+class PatchReader :
+  """ Strict, streaming reader for patch files
+
+  The header is checked as soon as the reader is built, so that a bad file
+  is rejected before anything is done to the graph. Edges are then yielded
+  line by line, a bad line raising only when it is reached : read() takes
+  the whole file in first, for callers that must not stop halfway. Legacy
+  files, a python dict printed by older --save, are read with
+  ast.literal_eval and never evaluated. Every problem is a PatchError. """
+
+  def __init__(self, stream, name = "<stdin>") :
+    self.stream = stream
+    self.name = name
+    self.lineno = 0
+    self.legacy = None
+    self.entries = None
+
+    header = self.readline()
+    if header is None :
+      raise PatchError(f"{name} : empty patch")
+
+    try :
+      value = json.loads(header)
+    except ValueError :
+      value = None
+
+    if isinstance(value, dict) and 'format' in value :
+      if PatchFormat != value['format'] :
+        raise PatchError(f"{name} : unknown format {value['format']!r}")
+      if PatchVersion != value.get('version') :
+        raise PatchError(f"{name} : unsupported version {value.get('version')!r}")
+    else :
+      self.legacy = self.read_legacy(header, value)
+
+  def readline(self) :
+    for line in self.stream :
+      self.lineno += 1
+      line = line.strip()
+      if 0 < len(line) :
+        return line
+    return None
+
+  def error(self, reason) :
+    return PatchError(f"{self.name}:{self.lineno} : {reason}")
+
+  def read_legacy(self, header, value) :
+    if value is None :
+      try :
+        value = ast.literal_eval(header + self.stream.read())
+      except (ValueError, SyntaxError, TypeError, MemoryError, RecursionError) as e :
+        raise self.error(f"not a patch file ({e})")
+
+    if not isinstance(value, dict) :
+      raise self.error("not a patch file")
+    ports, edges = value.get('ports', []), value.get('graph', [])
+    if not isinstance(ports, list) or not all(isinstance(port, str) for port in ports) :
+      raise self.error("ports must be a list of strings")
+    if not isinstance(edges, list) :
+      raise self.error("graph must be a list of edges")
+    for edge in edges :
+      if not isinstance(edge, (list, tuple)) or 2 != len(edge) or not all(isinstance(port, str) for port in edge) :
+        raise self.error(f"bad edge {edge!r}")
+    return ports, edges
+
+  def read(self) :
+    """ Reads and checks every entry now, raising PatchError on the first bad one """
+    if self.entries is None :
+      self.entries = list(self)
+    return self
+
+  def __iter__(self) :
+    """ Yields ('port', names) and ('edge', (src, dest)) in file order """
+    if self.entries is not None :
+      yield from self.entries
+      return
+    if self.legacy is not None :
+      ports, edges = self.legacy
+      yield from (('port', (port,)) for port in ports)
+      yield from (('edge', tuple(edge)) for edge in edges)
+      return
+
+    while True :
+      line = self.readline()
+      if line is None :
+        return
+      try :
+        value = json.loads(line)
+      except ValueError as e :
+        raise self.error(str(e))
+
+      if isinstance(value, str) :
+        yield 'port', (value,)
+      elif isinstance(value, dict) and isinstance(value.get('port'), str) :
+        aliases = value.get('aliases', [])
+        if not isinstance(aliases, list) or not all(isinstance(alias, str) for alias in aliases) :
+          raise self.error(f"bad aliases {aliases!r}")
+        yield 'port', (value['port'], *aliases)
+      elif isinstance(value, list) and 2 == len(value) and all(isinstance(port, str) for port in value) :
+        yield 'edge', tuple(value)
+      else :
+        raise self.error(f"unexpected entry {value!r}")
+
+  def edges(self, index = None) :
+    """ Yields the edges, feeding the names saved for each port to index """
+    for kind, value in self :
+      if 'edge' == kind :
+        yield value
+      elif index is not None :
+        index.add_saved(value)
+
+def apply_edges(backend, action, edges, report, graph = None) :
+  """ Connects or disconnects every edge through a single backend session
+
+  Successful edges are mirrored into graph, if given, so that it stays in
+  sync with the server without being scanned again. """
+  routine = backend.connect if 'connect' == action else backend.disconnect
+  for src, dest in edges :
+    start = time.perf_counter()
+    error = routine(src, dest)
+    report.add(action, src, dest, time.perf_counter() - start, error)
+
+    if graph is not None and error is None :
+      a, b = graph.resolve(src), graph.resolve(dest)
+      if a is not None and b is not None :
+        getattr(graph, action)(a, b)
+
+class Pending :
+  """ Edges waiting for their ports to be registered, until they expire
+
+  Edges are indexed by the normalized names they are missing, so that a
+  registration only looks at the edges waiting for that port. """
+
+  def __init__(self, timeout) :
+    self.timeout = timeout
+    self.deadlines = dict() # (src, dest) -> deadline
+    self.waiting = dict()   # missing name -> set of edges
+
+  def __len__(self) :
+    return len(self.deadlines)
+
+  def add(self, edge, missing) :
+    self.deadlines.setdefault(edge, time.monotonic() + self.timeout)
+    for name in missing :
+      self.waiting.setdefault(normalize(name), set()).add(edge)
+
+  def discard(self, edge) :
+    self.deadlines.pop(edge, None)
+    for name in map(normalize, edge) :
+      edges = self.waiting.get(name)
+      if edges is not None :
+        edges.discard(edge)
+        if 0 == len(edges) :
+          del self.waiting[name]
+
+  def clear(self) :
+    self.deadlines.clear()
+    self.waiting.clear()
+
+  def ready(self, index, ports) :
+    """ Removes the edges resolved by the newly registered ports, returning
+    them by port name """
+    candidates = set()
+    for port in ports :
+      for name in [port] + index.graph.ports.get(port, []) :
+        candidates.update(self.waiting.get(normalize(name), ()))
+
+    ready = list()
+    for src, dest in candidates :
+      a, b = index.resolve(src, True), index.resolve(dest, False)
+      if a is not None and b is not None :
+        self.discard((src, dest))
+        ready.append((a, b))
+    return ready
+
+  def expire(self, now) :
+    """ Removes and returns the edges whose deadline has passed """
+    expired = [edge for edge, deadline in self.deadlines.items() if deadline <= now]
+    for edge in expired :
+      self.discard(edge)
+    return expired
+
+  def next_deadline(self) :
+    return min(self.deadlines.values(), default=None)
+
+class Patcher :
+  """ Save, clear, load and apply operations over one backend session
+
+  With watch set and a libjack backend, the graph is kept in memory by a
+  Watcher rather than scanned again for every operation. Edges whose ports
+  are not registered yet are then held for up to wait seconds, and made as
+  soon as their ports show up : the patcher is selectable, and update must
+  be called whenever it is readable or its timeout runs out. """
+
+  def __init__(self, backend, verbose = False, watch = False, wait = 0) :
+    self.backend = backend
+    self.verbose = verbose
+    self.watcher = None
+    self.index = None
+    self.pending = Pending(wait)
+    self.wake_r, self.wake_w = os.pipe()
+    os.set_blocking(self.wake_r, False)
+    os.set_blocking(self.wake_w, False)
+    if watch and isinstance(backend, LibJack) :
+      self.watcher = Watcher(backend, self.wake)
+    else :
+      self.pending.timeout = 0
+
+  def fileno(self) :
+    return self.wake_r
+
+  def wake(self) :
+    try :
+      os.write(self.wake_w, b'\0')
+    except BlockingIOError :
+      pass # already awake
+
+  def timeout(self) :
+    """ Seconds until the next pending edge expires, None if there is none """
+    deadline = self.pending.next_deadline()
+    if deadline is None :
+      return None
+    return max(deadline - time.monotonic(), 0)
+
+  def update(self, report) :
+    """ Applies JACK notifications, connecting pending edges whose ports have
+    registered and dropping the ones that expired """
+    try :
+      while os.read(self.wake_r, 512) :
+        pass
+    except BlockingIOError :
+      pass
+
+    if self.watcher is not None :
+      graph = self.graph()
+      registered = self.watcher.take_registered()
+      if self.index is not None :
+        ready = self.pending.ready(self.index, registered)
+        apply_edges(self.backend, 'connect', ready, report, graph)
+
+    expired = self.pending.expire(time.monotonic())
+    if expired :
+      # Last chance for devices that came back under another name
+      apply_edges(self.backend, 'connect', self.resolved(expired, report, self.index, False), report, self.index.graph)
+
+  def resolved(self, edges, report, index, defer = True) :
+    """ Yields the edges whose ports exist by port name, holding the others
+    as pending if defer is set and the patcher waits for ports """
+    for src, dest in edges :
+      a, b = index.resolve(src, True), index.resolve(dest, False)
+      if a is not None and b is not None :
+        yield a, b
+        continue
+
+      missing = [name for name, port in ((src, a), (dest, b)) if port is None]
+      if defer and 0 < self.pending.timeout :
+        self.pending.add((src, dest), missing)
+        report.defer(src, dest, missing)
+      else :
+        report.add('connect', src, dest, 0, f"no such port {', '.join(missing)}")
+
+  def graph(self) :
+    if self.watcher is not None :
+      return self.watcher.graph()
+    if isinstance(self.backend, LibJack) :
+      return self.backend.scan()
+    return Graph.scan()
+
+  def save(self, path, graph = None) :
+    """ Writes the graph to path through a temporary file, so that a failed
+    save never leaves a truncated patch behind """
+    if graph is None :
+      graph = self.graph()
+      if self.watcher is not None :
+        self.watcher.refresh_aliases()
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as stream :
+      graph.save(stream)
+    os.replace(tmp, path)
+
+  def clear(self, report, graph = None) :
+    if graph is None :
+      graph = self.graph()
+    self.pending.clear()
+    apply_edges(self.backend, 'disconnect', list(graph.edges()), report, graph)
+
+  def load(self, patch, report, graph = None) :
+    if graph is None :
+      graph = self.graph()
+    self.index = PortIndex(graph)
+    edges = self.resolved(patch.edges(self.index), report, self.index)
+    apply_edges(self.backend, 'connect', edges, report, graph)
+
+  def apply(self, patch, report, graph = None) :
+    if graph is None :
+      graph = self.graph()
+    self.pending.clear()
+    self.index = PortIndex(graph)
+    connect, disconnect = graph.diff(patch.edges(self.index), self.index.resolve)
+
+    # Make before break : ports kept in the patch never go silent
+    apply_edges(self.backend, 'connect', self.resolved(connect, report, self.index), report, graph)
+    apply_edges(self.backend, 'disconnect', disconnect, report, graph)
+
+  def close(self) :
+    self.backend.close()
+    os.close(self.wake_r)
+    os.close(self.wake_w)
+
+def default_socket() :
+  runtime = os.environ.get('XDG_RUNTIME_DIR') or '/tmp'
+  return os.path.join(runtime, f"jack-patch-{os.getuid()}.sock")
+
+class RequestHandler(socketserver.StreamRequestHandler) :
+  """ One command line per connection : 'save PATH', 'load PATH', 'apply PATH',
+  'clear', 'ping' or 'metrics [PATH]'. It gets a single 'ok ...' or 'error ...'
+  line back, then the connection is closed.
+
+  Requests are served by the daemon loop itself, so a client must not hold it :
+  one that does not send its line within timeout seconds is dropped. """
+
+  timeout = 1
+
+  def handle(self) :
+    try :
+      line = self.rfile.readline()
+    except OSError : # timed out
+      return
+    command, _, path = line.decode().strip().partition(' ')
+    if 0 == len(command) :
+      return
+    try :
+      reply = 'ok ' + self.server.run(command, path)
+    except (OSError, ValueError) as e :
+      reply = f"error {e}"
+    except Exception as e : # still an answer, so the client does not fall back on a one shot run
+      reply = f"error {type(e).__name__}: {e}"
+    self.wfile.write((reply.replace('\n', ' ') + '\n').encode())
+
+class PatchServer(socketserver.UnixStreamServer) :
+  """ Long running patcher, keeping its JACK session across requests
+
+  Every command and edge is timed into metrics, which the 'metrics' command
+  returns, or writes to a file as JSON. Rejected commands are all counted as
+  'unknown', whatever the client sent. """
+
+  Commands = ('ping', 'save', 'clear', 'load', 'apply', 'metrics')
+
+  def __init__(self, path, patcher, metrics = None) :
+    if os.path.exists(path) :
+      os.unlink(path)
+    super().__init__(path, RequestHandler)
+    self.path = path
+    self.patcher = patcher
+    self.metrics = metrics or sfxmetrics.Metrics("jack-patch")
+    self.timed = self.metrics.wrap(lambda command, path, start : command if command in self.Commands else 'unknown',
+      self.execute, operation = True)
+
+  def run(self, command, path) :
+    return self.timed(command, path, time.perf_counter())
+
+  def execute(self, command, path, start) :
+    report = Report(self.patcher.verbose, self.metrics)
+
+    if 'metrics' == command :
+      if path :
+        self.metrics.dump(path)
+        return f"metrics written to {path}"
+      return "; ".join(self.metrics.lines())
+    elif 'ping' == command :
+      pass
+    elif 'save' == command :
+      self.patcher.save(path)
+    elif 'clear' == command :
+      self.patcher.clear(report)
+    elif command in ('load', 'apply') :
+      with open(path) as stream :
+        getattr(self.patcher, command)(PatchReader(stream, path).read(), report)
+    else :
+      raise ValueError(f"unknown command {command}")
+
+    report.summary()
+    return "; ".join([f"{command} in {(time.perf_counter() - start) * 1000:.1f}ms"] + report.totals())
+
+  def server_close(self) :
+    super().server_close()
+    if os.path.exists(self.path) :
+      os.unlink(self.path)
+
+def serve(path, patcher, metrics = None) :
+  with PatchServer(path, patcher, metrics) as server, selectors.DefaultSelector() as selector :
+    signal.signal(signal.SIGTERM, lambda *args : sys.exit(0))
+    print(f"jack-patch: serving on {path}", file=sys.stderr)
+    selector.register(server, selectors.EVENT_READ)
+    selector.register(patcher, selectors.EVENT_READ)
+    try :
+      while True :
+        for key, events in selector.select(patcher.timeout()) :
+          if key.fileobj is server :
+            server.handle_request()
+        report = Report(patcher.verbose, server.metrics)
+        patcher.update(report)
+        report.summary()
+    except KeyboardInterrupt :
+      pass
+    finally :
+      patcher.close()
+      server.metrics.stopDumping()
+
+if __name__ == "__main__" :
+
+  parser = argparse.ArgumentParser(description="Jackpatch utility reworked for finer usage")
+  parser.add_argument('--save', action='store_true', help='dump current patchbay to stdout')
+  parser.add_argument('--load', action='store_true', help='load a patchbay from stdin')
+  parser.add_argument('--clear', action='store_true', help='Clear all connections')
+  parser.add_argument('--apply', action='store_true', help='switch to a patchbay read from stdin, touching only edges that change')
+  parser.add_argument('--query', type=str, action='append', metavar='PORT', help='print ports connected to PORT, by name or alias')
+  parser.add_argument('--serve', type=str, nargs='?', const=default_socket(), metavar='SOCKET', help='run as a daemon taking commands on a unix socket')
+  parser.add_argument('--wait', type=float, metavar='SECONDS', help='hold edges whose ports are not registered yet for up to SECONDS (30 when serving, 0 otherwise)')
+  parser.add_argument('--verbose', action='store_true', help='report timing of each edge on stderr')
+  parser.add_argument('--metrics-file', type=str, metavar='PATH', help='write command and edge timings to PATH as JSON, on exit or every --metrics-interval when serving')
+  parser.add_argument('--metrics-interval', type=float, default=10, metavar='SECONDS', help='seconds between two writes of --metrics-file when serving')
+
+  args = parser.parse_args()
+  metrics = sfxmetrics.Metrics("jack-patch")
+
+  if args.serve is not None :
+    if args.metrics_file is not None :
+      metrics.dumpEvery(args.metrics_file, args.metrics_interval)
+    serve(args.serve, Patcher(open_backend(), args.verbose, watch=True, wait=30 if args.wait is None else args.wait), metrics)
+    sys.exit(0)
+
+  patcher = None
+  graph = None
+  if args.save or args.clear or args.apply or args.query or args.load :
+    patcher = Patcher(open_backend(), args.verbose, watch=bool(args.wait), wait=args.wait or 0)
+    graph = patcher.graph()
+
+  for name in args.query or [] :
+    for port in graph.connections(name) :
+      print(f"{name} {graph.label(port)}")
+
+  if args.save :
+
+    graph.save(sys.stdout)
+
+  if args.load or args.apply :
+
+    try :
+      # Prevent clearing the graph if load failed : every line is checked before anything is done
+      patch = PatchReader(sys.stdin).read()
+    except PatchError as e :
+      print(f"jack-patch: {e}", file=sys.stderr)
+      sys.exit(1)
+
+  report = Report(args.verbose, metrics)
+
+  status = 0
+  try :
+
+    if args.clear :
+      patcher.clear(report, graph)
+
+    if args.apply :
+      patcher.apply(patch, report, graph)
+
+    if args.load :
+      patcher.load(patch, report, graph)
+
+    if patcher is not None and 0 < len(patcher.pending) :
+      with selectors.DefaultSelector() as selector :
+        selector.register(patcher, selectors.EVENT_READ)
+        while 0 < len(patcher.pending) :
+          selector.select(patcher.timeout())
+          patcher.update(report)
+
+  except PatchError as e :
+    print(f"jack-patch: {e}", file=sys.stderr)
+    status = 1
+
+  if patcher is not None :
+    patcher.close()
+    report.summary()
 
-  if args.load :
+  if args.metrics_file is not None :
+    metrics.dump(args.metrics_file)
 
-    for src, dest in raw['graph'] :
-      sp.run(['jack_connect', src, dest])
-      # TODO add beautifull warning if port doesn't exists
+  sys.exit(status)
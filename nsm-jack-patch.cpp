@@ -3,6 +3,9 @@
 #include <5FX/logger.hpp>
 
 #include <sys/types.h>
+#include <sys/socket.h>
+#include <sys/wait.h>
+#include <sys/un.h>
 #include <unistd.h>
 
 #include <lo/lo_cpp.h>
@@ -17,12 +20,13 @@
 #include <atomic>
 #include <thread>
 #include <chrono>
+#include <cstring>
 #include <regex>
 #include <set>
 
 #include <signal.h>
 
-constexpr const char* EmptyPatch = "{'ports': [], 'graph': []}";
+constexpr const char* EmptyPatch = "{\"format\": \"jack-patch\", \"version\": 2}\n";
 
 MAKE_DEFAULTED(CurrentPatch, std::string, "default.pb");
 
@@ -66,16 +70,83 @@ bool has_nsm;
 
 Config global_config;
 
+pid_t patch_daemon = -1;
+
 namespace details
 {
+  std::filesystem::path patch_socket()
+  {
+    const char* runtime = std::getenv("XDG_RUNTIME_DIR");
+    return std::filesystem::path(runtime ? runtime : "/tmp") / ("jack-patch-" + std::to_string(getpid()) + ".sock");
+  }
+
+  void start_patch_daemon()
+  {
+    const auto path = patch_socket();
+    patch_daemon = fork();
+    if (0 == patch_daemon)
+    {
+      execlp("jack-patch.py", "jack-patch.py", "--serve", path.c_str(), nullptr);
+      _exit(127);
+    }
+  }
+  void stop_patch_daemon()
+  {
+    if (0 < patch_daemon)
+    {
+      kill(patch_daemon, SIGTERM);
+      waitpid(patch_daemon, nullptr, 0);
+      patch_daemon = -1;
+    }
+  }
+
+  /// Sends a command line to the jack-patch daemon
+  /// Returns false if the daemon can't be reached, so the caller can fall back on a one shot jack-patch.py
+  bool request(const std::string& command)
+  {
+    const auto path = patch_socket().string();
+    sockaddr_un addr{};
+    addr.sun_family = AF_UNIX;
+    if (sizeof(addr.sun_path) <= path.size())
+      return false;
+    std::strncpy(addr.sun_path, path.c_str(), sizeof(addr.sun_path) - 1);
+
+    int fd = socket(AF_UNIX, SOCK_STREAM, 0);
+    if (fd < 0)
+      return false;
+    if (::connect(fd, reinterpret_cast<sockaddr*>(&addr), sizeof(addr)) < 0)
+    {
+      close(fd);
+      return false;
+    }
+
+    const std::string line = command + "\n";
+    if (write(fd, line.data(), line.size()) != static_cast<ssize_t>(line.size()))
+    {
+      close(fd);
+      return false;
+    }
+
+    std::string reply;
+    char c;
+    while (1 == read(fd, &c, 1) && '\n' != c)
+      reply.push_back(c);
+    close(fd);
+
+    logger << "jack-patch : " << reply << std::endl;
+    return !reply.empty();
+  }
+
   void clear_patch()
   {
-    system(std::string("jack-patch.py --clear").c_str());
+    if (!request("clear"))
+      system(std::string("jack-patch.py --clear").c_str());
   }
   void save_patch(const std::string& path)
   {
     sfx::FileGuard(path, EmptyPatch);
-    system((std::string("jack-patch.py --save > ") + path).c_str());
+    if (!request("save " + path))
+      system((std::string("jack-patch.py --save > ") + path).c_str());
   }
   void load_patch(const std::string& path)
   {
@@ -83,7 +154,17 @@ namespace details
       clear_patch();
       save_patch(path);
     }));
-    system((std::string("jack-patch.py --load < ") + path).c_str());
+    if (!request("load " + path))
+      system((std::string("jack-patch.py --load < ") + path).c_str());
+  }
+  void apply_patch(const std::string& path)
+  {
+    sfx::FileGuard(path, EmptyPatch, std::make_optional([](const auto& path){
+      clear_patch();
+      save_patch(path);
+    }));
+    if (!request("apply " + path))
+      system((std::string("jack-patch.py --apply < ") + path).c_str());
   }
 }
 
@@ -92,8 +173,7 @@ void switch_patch(const std::string& path)
   const auto oldpatch = global_config.patch_path();
   const auto newpatch = global_config.patchbays_path() / path;
   details::save_patch(oldpatch);
-  details::clear_patch();
-  details::save_patch(newpatch);
+  details::apply_patch(newpatch);
   global_config.get<CurrentPatch>().set(newpatch);
 }
 
@@ -108,6 +188,8 @@ int main(int argc, char const* argv[], char const* env[])
 
   std::srand(std::time(nullptr));
 
+  details::start_patch_daemon();
+
   auto nsm_status = sfx::nsm::try_connect_to_server(argv[0], "5FX-Patcher", [](const sfx::nsm::Session& session){
     sfx::FileGuard patch_file{ global_config.patch_path(), global_config };
     details::save_patch(patch_file);
@@ -157,6 +239,12 @@ int main(int argc, char const* argv[], char const* env[])
         details::clear_patch();
         logger << "Clear" << std::endl;
       });
+    nsm_session->add_method("/patcher/apply", "", "",
+      [](lo_arg** argv, int) -> void
+      {
+        details::apply_patch(global_config.patch_path());
+        logger << "Apply : " << global_config.patch_path() << std::endl;
+      });
   }
 
   /* load session and everything else */
@@ -183,6 +271,7 @@ int main(int argc, char const* argv[], char const* env[])
   } while (run.test_and_set());
 
   nsm_session->osc_server->stop();
+  details::stop_patch_daemon();
 
   return 0;
 }
@@ -1,11 +1,329 @@
 #!/usr/bin/python3
 
-import subprocess as sp
+import asyncio
+import inspect
+import signal
+import sys
 import os
-import time
 import liblo
-import random
 import argparse
+import json
+import collections
+import fnmatch
+import time
+import ctypes.util
+import ctypes
+import struct
+import sfxmetrics
+
+class NSMError(Exception) :
+  def __init__(self, path, code, message) :
+    super().__init__(f"{path} : {message} ({code})")
+    self.path = path
+    self.code = code
+    self.message = message
+
+SessionClient = collections.namedtuple('SessionClient', ['name', 'executable', 'id'])
+
+class Inotify :
+  # Change notifications for directories, through the libc inotify calls
+  IN_MODIFY = 0x002
+  IN_CLOSE_WRITE = 0x008
+  IN_MOVED_TO = 0x080
+  IN_CREATE = 0x100
+  IN_DELETE = 0x200
+  IN_NONBLOCK = 0o4000
+  IN_CLOEXEC = 0o2000000
+  Event = struct.Struct("iIII")
+
+  def __init__(self) :
+    # Raises OSError where inotify is not available
+    self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno = True)
+    self.fd = self.libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+    if self.fd < 0 :
+      raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+    self.watches = {} # wd : callback(name)
+
+  def watch(self, directory, callback) :
+    wd = self.libc.inotify_add_watch(self.fd, os.fsencode(directory),
+      self.IN_MODIFY | self.IN_CLOSE_WRITE | self.IN_MOVED_TO | self.IN_CREATE | self.IN_DELETE)
+    if wd < 0 :
+      raise OSError(ctypes.get_errno(), f"cannot watch {directory}")
+    self.watches[wd] = callback
+
+  def read(self) :
+    try :
+      data = os.read(self.fd, 65536)
+    except BlockingIOError :
+      return
+    offset = 0
+    while offset < len(data) :
+      wd, mask, cookie, size = self.Event.unpack_from(data, offset)
+      offset += self.Event.size
+      name = data[offset:offset + size].rstrip(b"\0").decode()
+      offset += size
+      if wd in self.watches :
+        self.watches[wd](name)
+
+  def close(self) :
+    os.close(self.fd)
+
+class SessionFile :
+  # The clients of a session, read from its session.nsm with one "name:executable:id" line per client.
+  # Parsed once and kept until nsmd rewrites the file. With inotify the file is only
+  # looked at again after a change, otherwise its inode and mtime are compared on every access.
+  def __init__(self, directory, inotify = None) :
+    self.path = os.path.join(directory, "session.nsm")
+    self.key = None
+    self.entries = None
+    self.watched = False
+    self.inotify = inotify
+
+  def changed(self, name) :
+    if name == "session.nsm" :
+      self.entries = None
+
+  def clients(self) :
+    if not self.watched and self.inotify is not None :
+      try :
+        self.inotify.watch(os.path.dirname(self.path), self.changed)
+        self.watched = True
+        self.entries = None
+      except OSError :
+        pass # the session directory does not exist yet, try again next time
+
+    if self.watched and self.entries is not None :
+      return self.entries
+
+    try :
+      st = os.stat(self.path)
+    except FileNotFoundError :
+      self.key = None
+      self.entries = []
+      return self.entries
+    key = (st.st_ino, st.st_mtime_ns, st.st_size)
+    if key != self.key or self.entries is None :
+      self.key = key
+      self.entries = self.parse(self.path)
+    return self.entries
+
+  @staticmethod
+  def parse(path) :
+    entries = []
+    with open(path) as f :
+      for number, line in enumerate(f, 1) :
+        line = line.strip()
+        if not line :
+          continue
+        fields = line.split(":", 2)
+        if len(fields) != 3 :
+          print(f"5FX-Server : {path}:{number} : skipping malformed client {line!r}")
+          continue
+        entries.append(SessionClient(*fields))
+    return entries
+
+SfxMethod = collections.namedtuple('SfxMethod', ['client', 'path', 'params', 'description'])
+
+class SfxClient :
+  def __init__(self, client_id, host, port) :
+    self.id = client_id
+    self.host = host
+    self.port = port
+    self.url = f"osc.udp://{host}:{port}/"
+    self.address = liblo.Address(host, port) # built once, every forwarded message reuses it
+    self.methods = {} # path : SfxMethod
+
+class Registry :
+  # What the 5FX clients announced on /sfx/new/client and /sfx/new/method,
+  # indexed by client and by method path. Subscribers get every announce forwarded.
+  def __init__(self) :
+    self.clients = {} # client id : SfxClient
+    self.methods = collections.defaultdict(dict) # method path : { client id : SfxMethod }
+    self.addresses = {} # (host, port) : SfxClient
+    self.subscribers = {} # url : liblo.Address
+
+  def add_client(self, client_id, host, port) :
+    # A client announcing itself again was restarted, its methods come again as well
+    self.remove_client(client_id)
+    client = SfxClient(client_id, host, port)
+    self.clients[client_id] = client
+    self.addresses[(host, port)] = client
+    return client
+
+  def remove_client(self, client_id) :
+    client = self.clients.pop(client_id, None)
+    if client is None :
+      return
+    if self.addresses.get((client.host, client.port)) is client :
+      del self.addresses[(client.host, client.port)]
+    for path in client.methods :
+      del self.methods[path][client_id]
+      if not self.methods[path] :
+        del self.methods[path]
+
+  def add_method(self, client_id, path, params, description) :
+    client = self.clients.get(client_id)
+    if client is None :
+      return None
+    method = SfxMethod(client_id, path, params, description)
+    client.methods[path] = method
+    self.methods[path][client_id] = method
+    return method
+
+  def providers(self, path) :
+    # The clients having a method path
+    return [self.clients[client_id] for client_id in self.methods.get(path, {})]
+
+  def subscribe(self, address) :
+    self.subscribers[address.url] = address
+
+  def unsubscribe(self, address) :
+    self.subscribers.pop(address.url, None)
+
+class Traffic :
+  # Delivery counters of one client
+  def __init__(self) :
+    self.forwarded = 0
+    self.failed = 0
+    self.answered = 0
+    self.unanswered = 0
+    self.latency = 0.0 # sum of reply latencies, seconds
+    self.latency_max = 0.0
+
+  def answer(self, latency) :
+    self.answered += 1
+    self.latency += latency
+    self.latency_max = max(self.latency_max, latency)
+
+  def latency_mean(self) :
+    return self.latency / self.answered if self.answered else 0.0
+
+class Router :
+  # Forwards /sfx/<client>/<method> to <method> of the client, through the one sfx socket.
+  # <client> may be a pattern like *, then every matching client having <method> gets it.
+  # A /reply or /error of the client with <method> as first argument goes back to the sender.
+  # Methods in Lists answer like nsmd lists, one /reply per row then an empty one : every row goes back.
+  Prefix = "/sfx/"
+  ReplyTimeout = 5
+  Lists = { "/sfx/metrics" }
+
+  def __init__(self, registry, server) :
+    self.registry = registry
+    self.server = server # a Server
+    self.traffic = collections.defaultdict(Traffic) # client id : Traffic
+    self.pending = collections.defaultdict(collections.deque) # (client id, method) : (sender, time sent), oldest first
+
+  def split(self, path) :
+    # /sfx/client/some/method -> ("client", "/some/method")
+    client, sep, method = path[len(self.Prefix):].partition("/")
+    if not client or not method :
+      return None, None
+    return client, "/" + method
+
+  def targets(self, client, method) :
+    if client in self.registry.clients :
+      return [self.registry.clients[client]]
+    if not any(c in client for c in "*?[") :
+      return []
+    return [c for c in self.registry.providers(method) if fnmatch.fnmatchcase(c.id, client)]
+
+  def forward(self, path, args, types, sender) :
+    # Returns the number of clients the message went to
+    client, method = self.split(path)
+    if client is None :
+      return 0
+    targets = self.targets(client, method)
+    if not targets :
+      return 0
+
+    args = list(zip(types, args))
+    now = time.monotonic()
+    for target in targets :
+      traffic = self.traffic[target.id]
+      try :
+        self.server.send(target.address, method, *args)
+      except IOError :
+        traffic.failed += 1
+        continue
+      traffic.forwarded += 1
+      if sender is None : # sent by the server itself, nobody to give the answer to
+        continue
+      waiting = self.pending[(target.id, method)]
+      self.expire(target.id, waiting, now)
+      waiting.append((sender, now))
+    return len(targets)
+
+  def expire(self, client_id, waiting, now) :
+    while waiting and now - waiting[0][1] > self.ReplyTimeout :
+      waiting.popleft()
+      self.traffic[client_id].unanswered += 1
+
+  def answer(self, path, args, types, source) :
+    # A /reply or /error from a client. Returns False if we did not forward anything it answers
+    client = self.registry.addresses.get((source.hostname, source.port))
+    if client is None or not args :
+      return False
+    waiting = self.pending.get((client.id, args[0]))
+    if not waiting :
+      return False
+    sender, sent = waiting[0]
+    if path == "/error" or args[0] not in self.Lists or (len(args) == 2 and args[1] == "") :
+      waiting.popleft() # answered, unless it was a row of a list
+      latency = time.monotonic() - sent
+      self.traffic[client.id].answer(latency)
+      self.server.metrics.roundTrip(f"{self.Prefix}{client.id}{args[0]}", latency)
+    self.server.send(sender, path, *zip(types, args))
+    return True
+
+class SessionStatus :
+  # The clients of the open session and how far they are, from nsmd's GUI protocol.
+  # nsmd launches every client first, then they report "open" and "ready" one by one.
+  # ready is set once all of them have reported, so opening takes as long as the slowest client.
+  Done = ("ready", "stopped", "removed") # a client that crashed will not get any further
+
+  def __init__(self) :
+    self.name = ""
+    self.clients = {} # client id : status
+    self.names = {} # client id : name
+    self.opened = None # loop time the session started to open
+    self.ready = asyncio.Event()
+    self.listeners = [] # routines called with the SessionStatus when the session is ready
+
+  def open(self, name, now) :
+    self.name = name
+    self.clients.clear()
+    self.names.clear()
+    self.opened = now
+    self.ready.clear()
+
+  def close(self) :
+    self.name = ""
+    self.clients.clear()
+    self.names.clear()
+    self.ready.clear()
+
+  def add(self, client_id, name) :
+    self.names[client_id] = name
+    self.clients.setdefault(client_id, "launch")
+
+  def update(self, client_id, status) :
+    # Returns True when this makes the session ready
+    self.clients[client_id] = status
+    return self.check()
+
+  def loaded(self) :
+    # nsmd answered the open : nothing more to wait for, even if there is no client
+    return self.check(force = True)
+
+  def check(self, force = False) :
+    if not self.name or self.ready.is_set() :
+      return False
+    if not force and (not self.clients or any(s not in self.Done for s in self.clients.values())) :
+      return False
+    self.ready.set()
+    for listener in self.listeners :
+      listener(self)
+    return True
 
 class NSMCommand :
   def __init__(self, help, *args, **kwargs) :
@@ -14,50 +332,170 @@ class NSMCommand :
 
     self.quit = False
     self.load = False
+    self.collect = False # the answer is one /reply per item, ending with an empty one
+    self.answer = True # False for what nsmd does not answer, like quit : it just exits
+    self.timeout = 10
 
     for key, value in kwargs.items() :
       self.__dict__[key] = value
 
-  def call(self, cmd, context, **kwargs) :
-    msg = liblo.Message(f"/nsm/server/{cmd}")
+  async def call(self, cmd, context, **kwargs) :
+    # Returns the answer of nsmd, raises NSMError or asyncio.TimeoutError
+    path = f"/nsm/server/{cmd}"
+    message = []
+    session = None
     for t, arg in self.args :
 
       if arg in kwargs :
         val = kwargs[arg]
       else :
-        val = input(f"{arg} << ")
+        val = await context.input(f"{arg} << ")
 
       if self.load :
-        context.currentSession = val
+        session = val
 
-      msg.add((t, val))
+      message.append((t, val))
 
-    context.nsm_server.server.send(context.address, msg)
+    if self.answer :
+      reply = await context.request(path, message, self.timeout, self.collect)
+    else :
+      context.nsm_server.send(context.address, path, *message)
+      reply = None
+    if self.load :
+      context.currentSession = session
+      context.status.loaded()
     if self.quit :
       context.currentSession = ""
+    return reply
 
 class Command :
   def __init__(self, help, routine) :
     self.help = help
     self.routine = routine
 
-  def call(self, cmd, context, **kwargs) :
-    self.routine(context)
+  async def call(self, cmd, context, **kwargs) :
+    result = self.routine(context)
+    if inspect.isawaitable(result) :
+      result = await result
+    return result
 
 class Server :
-  def __init__(self, port) -> None:
+  def __init__(self, port = None, metrics = None) -> None:
+    # Without port the system assigns a free one. Raises liblo.ServerError
+    self.server = liblo.Server(port, liblo.UDP)
+    self.port = self.server.port
+    self.url = 'osc.udp://localhost:' + str(self.port)
+    self.metrics = metrics if metrics is not None else sfxmetrics.Metrics("server")
+
+  def add_method(self, path, types, callback, data) :
+    # Like liblo's, every message handled is counted and timed under the path it came with
+    metrics = self.metrics
+    timed = metrics.wrap(lambda path, *rest : path, callback)
+    def handle(path, args, types, address, data) :
+      metrics.receive(path, sfxmetrics.oscSize(path, types, args))
+      return timed(path, args, types, address, data) # the catch all method depends on the result
+    self.server.add_method(path, types, handle, data)
+
+  def send(self, address, path, *args) :
+    # args are values or (typetag, value) pairs, as for liblo.send
+    self.server.send(address, path, *args)
+    types = "".join(arg[0] if isinstance(arg, tuple) else self.typetag(arg) for arg in args)
+    values = [arg[1] if isinstance(arg, tuple) else arg for arg in args]
+    self.metrics.send(path, sfxmetrics.oscSize(path, types, values))
+
+  @staticmethod
+  def typetag(arg) :
+    if isinstance(arg, int) :
+      return 'i'
+    if isinstance(arg, float) :
+      return 'f'
+    if isinstance(arg, (bytes, bytearray, list)) :
+      return 'b'
+    return 's'
 
-    success = False
-    for t in range(5) :
+  def attach(self, loop) :
+    # Messages are dispatched by the event loop as soon as the socket is readable
+    loop.add_reader(self.server.fileno(), self.receive)
+
+  def detach(self, loop) :
+    loop.remove_reader(self.server.fileno())
+
+  def receive(self) :
+    while self.server.recv(0) :
+      pass
+
+  def free(self) :
+    self.server.free()
+
+def process_start(pid) :
+  # Start time of a process, to tell it from a later one with the same pid. None if unknown
+  try :
+    with open(f"/proc/{pid}/stat") as f :
+      return int(f.read().rsplit(")", 1)[1].split()[19])
+  except (OSError, IndexError, ValueError) :
+    return None
+
+class RuntimeFile :
+  # Each running server publishes its urls in $XDG_RUNTIME_DIR/5FX/server-<pid>.json,
+  # so controllers and other servers can find them. Files of processes that are gone are stale.
+  Directory = os.path.join(os.environ.get("XDG_RUNTIME_DIR", "/tmp"), "5FX")
+
+  def __init__(self) :
+    self.path = os.path.join(self.Directory, f"server-{os.getpid()}.json")
+
+  @staticmethod
+  def alive(entry) :
+    pid = entry.get("pid")
+    try :
+      os.kill(pid, 0)
+    except ProcessLookupError :
+      return False
+    except PermissionError :
+      pass
+    except TypeError :
+      return False
+    start = process_start(pid)
+    return start is None or entry.get("start") in (None, start)
+
+  @classmethod
+  def servers(cls) :
+    # The servers running on this host. Stale files are removed on the way
+    servers = []
+    try :
+      names = os.listdir(cls.Directory)
+    except FileNotFoundError :
+      return servers
+    for name in names :
+      if not (name.startswith("server-") and name.endswith(".json")) :
+        continue
+      path = os.path.join(cls.Directory, name)
       try :
-        self.port = port + random.randint(1, 10000)
-        self.url = 'osc.udp://localhost:' + str(self.port)
-        self.server = liblo.ServerThread(self.port, liblo.UDP)
-        success = True
-      except liblo.ServerError :
-        pass
-    if not success :
-      exit(-1)
+        with open(path) as f :
+          entry = json.load(f)
+      except (OSError, ValueError) :
+        continue
+      if cls.alive(entry) :
+        servers.append(entry)
+      else :
+        try :
+          os.remove(path)
+        except OSError :
+          pass
+    return servers
+
+  def publish(self, **entries) :
+    os.makedirs(self.Directory, mode = 0o700, exist_ok = True)
+    entries.update(pid = os.getpid(), start = process_start(os.getpid()))
+    tmp = self.path + ".tmp"
+    with open(tmp, "w") as f :
+      json.dump(entries, f)
+    os.replace(tmp, self.path)
+
+  def remove(self) :
+    try :
+      os.remove(self.path)
+    except FileNotFoundError :
+      pass
 
 class Context :
   def __init__(self, root, port, commands) :
@@ -68,35 +506,317 @@ class Context :
     if not os.path.exists(self.sessionRoot) :
       os.makedirs(self.sessionRoot)
 
-    self.nsm_server = Server(port+1)
-    self.sfx_server = Server(port+2)
+    for server in RuntimeFile.servers() : # also clears what crashed servers left
+      if port is not None and server.get("nsm_port") == port :
+        raise RuntimeError(f"Port {port} is used by the server of pid {server['pid']}")
+
+    self.metrics = sfxmetrics.Metrics("nsm-server")
+    self.nsm_server = Server(metrics = self.metrics)
+    self.sfx_server = Server(metrics = self.metrics)
 
-    self.url = 'osc.udp://localhost:' + str(port)
-    self.address = liblo.Address(self.url)
+    # Known once nsmd listens, see start
+    self.url = None
+    self.address = None
 
-    os.environ['NSM_URL'] = self.url
     os.environ['SFX_URL'] = self.sfx_server.url
+    self.runtime = RuntimeFile()
 
+    self.port = port
     self.commands = commands
     self.isRunning = True
-    self.daemon = sp.Popen(["nsmd", "--session-root", self.sessionRoot, "--osc-port", str(port)], env=os.environ)
-    self.sfx_server.server.add_method('/sfx/new/client', None, sfx_new_client_callback, self)
+    self.daemon = None
+    self.loop = None
+    self.stopped = None
+    self.lines = None
+    self.pending = b""
+    self.waiting = collections.defaultdict(collections.deque) # path : requests waiting for their /reply, oldest first
+    self.inotify = None
+    self.sessions = {} # session name : SessionFile
+    self.registry = Registry()
+    self.router = Router(self.registry, self.sfx_server)
+    self.status = SessionStatus()
+    self.status.listeners.append(self.session_ready)
 
-    self.sfx_server.server.add_method('/sfx/new/method', None, sfx_new_method_callback, self)
-    self.sfx_server.server.start()
+    self.nsm_server.add_method('/reply', None, nsm_reply_callback, self)
+    self.nsm_server.add_method('/error', None, nsm_error_callback, self)
+    # nsmd reports the session to us as to a GUI, see --gui-url
+    self.nsm_server.add_method('/nsm/gui/session/name', None, nsm_session_name_callback, self)
+    self.nsm_server.add_method('/nsm/gui/client/new', None, nsm_client_new_callback, self)
+    self.nsm_server.add_method('/nsm/gui/client/status', None, nsm_client_status_callback, self)
+
+    self.sfx_server.add_method('/sfx/new/client', None, sfx_new_client_callback, self)
+
+    self.sfx_server.add_method('/sfx/new/method', None, sfx_new_method_callback, self)
+    self.sfx_server.add_method('/sfx/query/clients', None, sfx_query_clients_callback, self)
+    self.sfx_server.add_method('/sfx/query/methods', None, sfx_query_methods_callback, self)
+    self.sfx_server.add_method('/sfx/query/method', 's', sfx_query_method_callback, self)
+    self.sfx_server.add_method('/sfx/subscribe', None, sfx_subscribe_callback, self)
+    self.sfx_server.add_method('/sfx/unsubscribe', None, sfx_unsubscribe_callback, self)
+    self.sfx_server.add_method('/sfx/metrics', None, sfx_metrics_callback, self)
+    self.sfx_server.add_method('/reply', None, sfx_answer_callback, self)
+    self.sfx_server.add_method('/error', None, sfx_answer_callback, self)
+    # Last, so it only gets what no method above took
+    self.sfx_server.add_method(None, None, sfx_route_callback, self)
     
 
-    print('NSM_URL =', os.environ['NSM_URL'])
     print('SFX_URL =', os.environ['SFX_URL'])
 
-  def call(self, cmd, **kwargs) :
-    self.commands[cmd].call(cmd, self, **kwargs)
+  def request(self, path, args, timeout, collect = False) :
+    # Send path with its (typetag, value) args to nsmd. The answer comes as /reply or /error
+    # with path as first argument, nsmd answers the commands for one path in order.
+    future = self.loop.create_future()
+    entry = [future, [] if collect else None, time.perf_counter()]
+    self.waiting[path].append(entry)
+    self.nsm_server.send(self.address, path, *args)
+    return self.wait_reply(path, entry, timeout)
+
+  async def wait_reply(self, path, entry, timeout) :
+    future, items, sent = entry
+    try :
+      return await asyncio.wait_for(asyncio.shield(future), timeout)
+    except asyncio.TimeoutError :
+      if items :
+        # older nsmd does not end lists with an empty reply, nothing more is coming
+        if entry in self.waiting[path] :
+          self.waiting[path].remove(entry)
+        return items
+      # The entry stays as a tombstone : nsmd answers in order, so its late answer
+      # is for this request and must not be taken for the answer of the next one
+      future.cancel()
+      raise
+
+  def on_reply(self, args) :
+    path = args[0] if args else ""
+    if not self.waiting.get(path) :
+      return False
+    entry = self.waiting[path][0]
+    future, items, sent = entry
+    if items is not None and len(args) > 1 and args[1] != "" :
+      items.append(args[1])
+      return True
+    self.waiting[path].popleft()
+    self.metrics.roundTrip(path, time.perf_counter() - sent)
+    if not future.done() : # else it timed out, the late answer goes nowhere
+      future.set_result(items if items is not None else args[1] if len(args) > 1 else None)
+    return True
+
+  def on_error(self, args) :
+    path = args[0] if args else ""
+    if not self.waiting.get(path) :
+      return False
+    future, items, sent = self.waiting[path].popleft()
+    self.metrics.roundTrip(path, time.perf_counter() - sent)
+    if not future.done() :
+      future.set_exception(NSMError(path, args[1] if len(args) > 1 else 0, args[2] if len(args) > 2 else ""))
+    return True
+
+  async def wait_daemon(self, timeout = 10) :
+    # nsmd answers /osc/ping once it listens. Returns as soon as it does.
+    # The ping is sent again until then, all under one request : any answer will do
+    reply = self.loop.create_task(self.request('/osc/ping', [], timeout))
+    while True :
+      done, pending = await asyncio.wait([reply], timeout = 0.1)
+      if done :
+        return reply.result()
+      if self.stopped.is_set() :
+        reply.cancel()
+        raise asyncio.TimeoutError()
+      self.nsm_server.send(self.address, '/osc/ping')
+
+  async def start(self, cli = True) :
+    # Everything runs in one asyncio loop : the OSC sockets, stdin and nsmd
+    self.loop = asyncio.get_running_loop()
+    self.stopped = asyncio.Event()
+
+    # Without a port nsmd binds a free one and prints NSM_URL=osc.udp://host:port/
+    command = ["nsmd", "--session-root", self.sessionRoot, "--gui-url", self.nsm_server.url]
+    if self.port is not None :
+      command += ["--osc-port", str(self.port)]
+    self.daemon = await asyncio.create_subprocess_exec(*command, env=os.environ,
+      stdout = asyncio.subprocess.PIPE, stderr = asyncio.subprocess.STDOUT)
+    self.loop.create_task(self.watch_daemon())
+    nsm_url = self.loop.create_future()
+    self.loop.create_task(self.read_daemon(nsm_url))
+    try :
+      url = await asyncio.wait_for(nsm_url, 10)
+    except asyncio.TimeoutError :
+      url = None
+    if url is None :
+      if self.port is None :
+        raise RuntimeError("nsmd did not tell its url")
+      url = 'osc.udp://localhost:' + str(self.port) + '/'
+    self.set_url(url)
+
+    try :
+      self.inotify = Inotify()
+      self.loop.add_reader(self.inotify.fd, self.inotify.read)
+    except (OSError, AttributeError) :
+      self.inotify = None # no inotify, session files are checked by mtime
+
+    self.nsm_server.attach(self.loop)
+    self.sfx_server.attach(self.loop)
+
+    for sig in (signal.SIGINT, signal.SIGTERM) :
+      self.loop.add_signal_handler(sig, self.stop)
+
+    if cli :
+      self.lines = asyncio.Queue()
+      self.loop.add_reader(sys.stdin.fileno(), self.read_stdin)
+
+  def set_url(self, url) :
+    self.url = url
+    self.address = liblo.Address(url)
+    os.environ['NSM_URL'] = url
+    print('NSM_URL =', url)
+    self.runtime.publish(root = self.sessionRoot, nsm_url = url, nsm_port = self.address.port,
+      sfx_url = self.sfx_server.url, sfx_port = self.sfx_server.port, control_url = self.nsm_server.url)
+
+  async def read_daemon(self, nsm_url) :
+    # Passes the output of nsmd through, taking its url on the way
+    while True :
+      line = await self.daemon.stdout.readline()
+      if not line :
+        break
+      text = line.decode(errors = "replace")
+      if text.startswith("NSM_URL=") and not nsm_url.done() :
+        nsm_url.set_result(text.strip()[len("NSM_URL="):])
+      sys.stderr.write(text)
+    if not nsm_url.done() :
+      nsm_url.set_result(None)
+
+  async def watch_daemon(self) :
+    code = await self.daemon.wait()
+    # Nothing is going to answer what still waits
+    for path, entries in self.waiting.items() :
+      for future, items, sent in entries :
+        if not future.done() :
+          future.set_exception(NSMError(path, -1, f"nsmd exited with code {code}"))
+    self.waiting.clear()
+    if self.isRunning :
+      print(f"nsmd exited with code {code}")
+      self.stop()
+
+  def read_stdin(self) :
+    data = os.read(sys.stdin.fileno(), 4096)
+    if not data :
+      self.loop.remove_reader(sys.stdin.fileno())
+      self.lines.put_nowait(None)
+      return
+    self.pending += data
+    *lines, self.pending = self.pending.split(b"\n")
+    for line in lines :
+      self.lines.put_nowait(line.decode().strip())
+
+  async def input(self, prompt) :
+    # Like input(), without blocking the loop. EOF stops the server
+    print(prompt, end = "", flush = True)
+    line = await self.lines.get()
+    if line is None :
+      self.stop()
+      raise EOFError()
+    return line
+
+  async def cli(self) :
+    while self.isRunning :
+      try :
+        cmd = await self.input("SessionFX << ")
+      except EOFError :
+        break
+
+      if 0 < len(cmd) :
+        if cmd in self.commands :
+          try :
+            result = await self.call(cmd)
+          except NSMError as e :
+            print("NSM error : ", e)
+          except asyncio.TimeoutError :
+            print(f"NSM : no answer to {cmd}")
+          except Exception as e : # a broken command must not take the command line down
+            print(f"5FX-Server : {cmd} failed : {e!r}")
+          else :
+            if isinstance(result, list) :
+              print(*result, sep = "\n")
+            elif result is not None :
+              print("NSM : ", result)
+
+  def stop(self) :
+    self.isRunning = False
+    self.stopped.set()
+
+  async def close(self) :
+    if self.daemon is not None and self.daemon.returncode is None :
+      if self.address is None : # nsmd never told its url
+        self.daemon.terminate()
+      else :
+        await self.call('quit') # nsmd saves the session then exits, without answering
+      try :
+        await asyncio.wait_for(self.daemon.wait(), self.commands['quit'].timeout)
+      except asyncio.TimeoutError :
+        self.daemon.terminate()
+        await self.daemon.wait()
+
+    if self.lines is not None :
+      self.loop.remove_reader(sys.stdin.fileno())
+    self.nsm_server.detach(self.loop)
+    self.sfx_server.detach(self.loop)
+    self.nsm_server.free()
+    self.sfx_server.free()
+    if self.inotify is not None :
+      self.loop.remove_reader(self.inotify.fd)
+      self.inotify.close()
+    self.runtime.remove()
+    self.metrics.stopDumping()
+
+  def session_ready(self, status) :
+    # Every client is up : the patchbay can connect all their ports now
+    print(f"Session ready : { status.name }, { len(status.clients) } clients in { self.loop.time() - status.opened :.2f} s")
+    self.router.forward("/sfx/*/patcher/apply", [], "", None)
+
+  def session_file(self, session = None) :
+    if session is None :
+      session = self.currentSession
+    if not session in self.sessions :
+      self.sessions[session] = SessionFile(os.path.join(self.sessionRoot, session), self.inotify)
+    return self.sessions[session]
+
+  async def call(self, cmd, **kwargs) :
+    return await self.commands[cmd].call(cmd, self, **kwargs)
     
-  def reload(self) :
+  async def reload(self) :
     tmp = self.currentSession
-    self.call('abort')
-    time.sleep(5)
-    self.call('open', project = tmp)
+    await self.call('abort')
+    return await self.call('open', project = tmp)
+
+
+def nsm_reply_callback(path, args, types, address, context) :
+  if not context.on_reply(args) :
+    print("NSM : ", *args)
+
+
+def nsm_error_callback(path, args, types, address, context) :
+  if not context.on_error(args) :
+    print("NSM error : ", *args)
+
+
+def nsm_session_name_callback(path, args, types, address, context) :
+  # An empty name means the session was closed
+  if args and args[0] :
+    context.status.open(args[0], context.loop.time())
+  else :
+    context.status.close()
+
+
+def nsm_client_new_callback(path, args, types, address, context) :
+  context.status.add(args[0], args[1] if len(args) > 1 else args[0])
+
+
+def nsm_client_status_callback(path, args, types, address, context) :
+  context.status.update(args[0], args[1])
+
+
+def sfx_notify(context, path, *args) :
+  for subscriber in context.registry.subscribers.values() :
+    context.sfx_server.send(subscriber, path, *args)
 
 
 def sfx_new_client_callback(path, args, types, address, context) :
@@ -104,6 +824,8 @@ def sfx_new_client_callback(path, args, types, address, context) :
   client_port = args[1]
   
   print("5FX-Server New Client : ", client_id, client_port)
+  context.registry.add_client(client_id, address.hostname, client_port)
+  sfx_notify(context, path, *args)
 
 
 def sfx_new_method_callback(path, args, types, address, context) :
@@ -114,6 +836,79 @@ def sfx_new_method_callback(path, args, types, address, context) :
   description = args[3]
   
   print("5FX-Server New Method : ", client_id, method, params, description)
+  if context.registry.add_method(client_id, method, params, description) is None :
+    print("5FX-Server Unknown Client : ", client_id)
+    return
+  sfx_notify(context, path, *args)
+
+
+# Queries are answered like nsmd lists : one /reply per item, then an empty one
+
+def sfx_query_clients_callback(path, args, types, address, context) :
+  send = context.sfx_server.send
+  for client in context.registry.clients.values() :
+    send(address, '/reply', path, client.id, client.url)
+  send(address, '/reply', path, "")
+
+
+def sfx_query_methods_callback(path, args, types, address, context) :
+  # All methods, or those of the client given as argument
+  send = context.sfx_server.send
+  clients = context.registry.clients
+  if args :
+    clients = { args[0] : clients[args[0]] } if args[0] in clients else {}
+  for client in clients.values() :
+    for method in client.methods.values() :
+      send(address, '/reply', path, client.id, method.path, method.params, method.description)
+  send(address, '/reply', path, "")
+
+
+def sfx_query_method_callback(path, args, types, address, context) :
+  # The clients providing a method path
+  send = context.sfx_server.send
+  for client in context.registry.providers(args[0]) :
+    method = client.methods[args[0]]
+    send(address, '/reply', path, client.id, client.url, method.params, method.description)
+  send(address, '/reply', path, "")
+
+
+def sfx_subscribe_callback(path, args, types, address, context) :
+  # The subscriber gets the current registry as announces first, then every new one
+  registry = context.registry
+  registry.subscribe(address)
+  send = context.sfx_server.send
+  for client in registry.clients.values() :
+    send(address, '/sfx/new/client', client.id, client.port)
+    for method in client.methods.values() :
+      send(address, '/sfx/new/method', client.id, method.path, method.params, method.description)
+  send(address, '/reply', path, "subscribed")
+
+
+def sfx_unsubscribe_callback(path, args, types, address, context) :
+  context.registry.unsubscribe(address)
+  context.sfx_server.send(address, '/reply', path, "unsubscribed")
+
+
+def sfx_metrics_callback(path, args, types, address, context) :
+  # One row per path : component, kind (in, out, op or rtt), path, count, bytes, errors, then mean, p50, p99 and max in ms
+  send = context.sfx_server.send
+  metrics = context.metrics
+  for kind, name, count, size, errors, mean, p50, p99, peak in metrics.rows() :
+    send(address, '/reply', path, metrics.component, kind, name,
+      ('i', count), ('i', size), ('i', errors), ('f', mean), ('f', p50), ('f', p99), ('f', peak))
+  send(address, '/reply', path, "")
+
+
+def sfx_route_callback(path, args, types, address, context) :
+  if not path.startswith(Router.Prefix) :
+    return
+  if not context.router.forward(path, args, types, address) :
+    context.sfx_server.send(address, '/error', path, -1, "No such client")
+
+
+def sfx_answer_callback(path, args, types, address, context) :
+  if not context.router.answer(path, args, types, address) :
+    print(f"5FX-Server {path} : ", *args)
 
 
 def cmd_help(context) :
@@ -122,81 +917,119 @@ def cmd_help(context) :
     print(cmd, ':', commands[cmd].help)
 
 def cmd_quit(context) :
-  context.isRunning = False
+  context.stop()
 
-def cmd_add(context) :
-  name = input("Program << ")
-  context.nsm_add(name)
+async def cmd_add(context) :
+  name = await context.input("Program << ")
+  await context.call('add', client = name)
 
-def cmd_reload(context) :
-  context.reload()
+async def cmd_reload(context) :
+  return await context.reload()
 def cmd_show(context) :
   if "" != context.currentSession :
+    clients = "\n".join([f"{ c.name }:{ c.executable }:{ c.id }" for c in context.session_file().clients()])
     print(f"""
 Context :
   Session = "{ context.currentSession }"
 
 Clients :
 
-{
-sp.run(["cat", os.path.join(context.sessionRoot, context.currentSession, "session.nsm")], stdout = sp.PIPE).stdout.decode()
-}
+{ clients }
 """)
   else :
     print("No Session oppend...")
 
+def cmd_sfx(context) :
+  for client in context.registry.clients.values() :
+    print(f"{ client.id } : { client.url }")
+    for method in client.methods.values() :
+      print(f"  { method.path } { method.params } : { method.description }")
+
+def cmd_traffic(context) :
+  for client_id, traffic in context.router.traffic.items() :
+    print(f"{ client_id } : { traffic.forwarded } forwarded, { traffic.failed } failed, "
+      f"{ traffic.answered } answered in { traffic.latency_mean() * 1000 :.2f} ms (max { traffic.latency_max * 1000 :.2f} ms), "
+      f"{ traffic.unanswered } unanswered")
+
+def cmd_metrics(context) :
+  for line in context.metrics.lines() :
+    print(line)
+
+def cmd_clients(context) :
+  if "" != context.currentSession :
+    for c in context.session_file().clients() :
+      print(f"{ c.id } : { c.name } ({ c.executable }) { context.status.clients.get(c.id, '') }")
+  else :
+    print("No Session oppend...")
+
 if __name__ == "__main__" :
 
   parser = argparse.ArgumentParser(
     description='Non Session Manager server for 5FX Environment')
   parser.add_argument('--root', type=str, nargs='?', help='NSM Session root')
-  parser.add_argument('--port', type=int, nargs='?', help='NSM Session port')
+  parser.add_argument('--port', type=int, nargs='?', help='NSM Session port, a free one by default')
   parser.add_argument('--session', type=str, nargs='?', help='NSM Session to load')
   parser.add_argument('--no-cli', action='store_true', help='Start without command line interface')
+  parser.add_argument('--metrics-file', type=str, help='Write the message and timing metrics to this file as JSON')
+  parser.add_argument('--metrics-interval', type=float, default=10, help='Seconds between two writes of --metrics-file')
   args = parser.parse_args()
 
   if args.root is None :
     args.root = os.environ['HOME'] + '/.5FX/5FX-Session/'
-  if args.port is None :
-    args.port = random.randint(10000, 32767)
   
   commands = {
     'help' : Command('display command list and help', cmd_help),
     'exit' : Command('quit this program', cmd_quit),
 
     'show' : Command('Print current session', cmd_show),
+    'clients' : Command('List the clients of the current session', cmd_clients),
+    'sfx' : Command('List the 5FX clients and their methods', cmd_sfx),
+    'traffic' : Command('Print the messages routed to each 5FX client', cmd_traffic),
+    'metrics' : Command('Print the messages and timings of the server', cmd_metrics),
 
     'add' : NSMCommand('Adds a client to the current session.', ('s', "client")),
-    'save' : NSMCommand('Saves the current session.'),
-    'open' : NSMCommand('Saves the current session and loads a new session.', ('s', "project"), load=True),
+    'save' : NSMCommand('Saves the current session.', timeout=60),
+    'open' : NSMCommand('Saves the current session and loads a new session.', ('s', "project"), load=True, timeout=60),
     'new' : NSMCommand('Saves the current session and creates a new session.', ('s', "project"), load=True),
-    'duplicate' : NSMCommand('Saves and closes the current session, makes a copy, and opens it.', ('s', "project"), load=True),
+    'duplicate' : NSMCommand('Saves and closes the current session, makes a copy, and opens it.', ('s', "project"), load=True, timeout=60),
     'reload' : Command('Abort session and reopen it', cmd_reload),
 
-    'close' : NSMCommand('Saves and closes the current session.', quit=True),
+    'close' : NSMCommand('Saves and closes the current session.', quit=True, timeout=60),
     'abort' : NSMCommand('Closes the current session WITHOUT SAVING', quit=True),
-    'quit' : NSMCommand('Saves and closes the current session and terminates the server.', quit=True),
+    'quit' : NSMCommand('Saves and closes the current session and terminates the server.', quit=True, answer=False, timeout=60),
 
-    'list' : NSMCommand('Lists available projects. One /reply message will be sent for each existing project.'),
+    'list' : NSMCommand('Lists available projects. One /reply message will be sent for each existing project.', collect=True),
     }
-  context = Context(args.root, args.port, commands)
+  try :
+    context = Context(args.root, args.port, commands)
+  except (liblo.ServerError, RuntimeError) as e :
+    print("5FX-Server :", e)
+    sys.exit(1)
 
-  if not args.session is None :
-    time.sleep(5)
-    context.nsm_open(args.session)
+  async def main() :
+    try :
+      await context.start(cli = not args.no_cli)
+    except RuntimeError as e :
+      print("5FX-Server :", e)
+      await context.close()
+      sys.exit(1)
 
-  while context.isRunning :
+    if args.metrics_file is not None :
+      context.metrics.dumpEvery(args.metrics_file, args.metrics_interval)
 
-    if args.no_cli :
-      time.sleep(1)
+    if not args.session is None :
+      try :
+        await context.wait_daemon()
+        print("NSM : ", await context.call('open', project = args.session))
+      except NSMError as e :
+        print("NSM error : ", e)
+      except asyncio.TimeoutError :
+        print(f"NSM : could not open {args.session}")
 
-    else :
-      cmd = input("SessionFX << ")
+    if not args.no_cli :
+      context.loop.create_task(context.cli())
 
-      if 0 < len(cmd) :
-        if cmd in commands :
-          commands[cmd].call(cmd, context)
+    await context.stopped.wait()
+    await context.close()
 
-  context.nsm_quit()
-  context.server.stop()
-  context.daemon.terminate()
\ No newline at end of file
+  asyncio.run(main())
\ No newline at end of file
@@ -30,14 +30,19 @@ OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWA
 import logging;
 logger = None #filled by init with prettyName
 
+import re
 import struct
 import socket
+import selectors
+import heapq
+import time
+import threading
 from os import getenv, getpid, kill
 import os
 import os.path
 import shutil
 from uuid import uuid4
-from sys import argv
+from sys import argv, platform
 from signal import signal, SIGTERM, SIGINT, SIGKILL #react to exit signals to close the client gracefully. Or kill if the client fails to do so.
 from urllib.parse import urlparse
 
@@ -46,23 +51,28 @@ class _IncomingMessage(object):
 
     An OSC message consists of an OSC Address Pattern followed by an OSC
     Type Tag String followed by zero or more OSC Arguments.
+
+    The address and type tags are parsed right away, the arguments only when they are first
+    accessed. Parsing works on offsets into the datagram with bytes.find and precompiled
+    structs, so the datagram is never copied, only the values themselves are.
     """
 
+    LENGTH = 4 #32 bit
+    _INT = struct.Struct('>i')
+    _FLOAT = struct.Struct('>f')
+    _LONG = struct.Struct('>q')
+    _DOUBLE = struct.Struct('>d')
+    _CONSTANTS = {"T": True, "F": False, "N": None} #types without data in the datagram
+
     def __init__(self, dgram):
-        #NSM Broadcasts are bundles, but very simple ones. We only need to care about the single message it contains.
-        #Therefore we can strip the bundle prefix and handle it as normal message.
-        if b"#bundle" in dgram:
-            bundlePrefix, singleMessage = dgram.split(b"/", maxsplit=1)
-            dgram = b"/" + singleMessage  # / eaten by split
-            self.isBroadcast = True
-        else:
-            self.isBroadcast = False
-        self.LENGTH = 4 #32 bit
+        self.isBroadcast = False #NSM Broadcasts are bundles. Set for messages taken out of a bundle.
         self._dgram = dgram
-        self._parameters = []
+        self._address_regexp = None
+        self._typeTags = ""
+        self._argumentsIndex = len(dgram)
+        self._parameters = None #decoded on first access
         self.parse_datagram()
 
-
     def get_int(self, dgram, start_index):
         """Get a 32-bit big-endian two's complement integer from the datagram.
 
@@ -77,20 +87,13 @@ class _IncomingMessage(object):
         ValueError if the datagram could not be parsed.
         """
         try:
-            if len(dgram[start_index:]) < self.LENGTH:
-                raise ValueError('Datagram is too short')
-            return (
-                struct.unpack('>i', dgram[start_index:start_index + self.LENGTH])[0], start_index + self.LENGTH)
-        except (struct.error, TypeError) as e:
+            return self._INT.unpack_from(dgram, start_index)[0], start_index + self.LENGTH
+        except struct.error as e:
             raise ValueError('Could not parse datagram %s' % e)
 
     def get_string(self, dgram, start_index):
         """Get a python string from the datagram, starting at pos start_index.
 
-        We receive always the full string, but handle only the part from the start_index internally.
-        In the end return the offset so it can be added to the index for the next parameter.
-        Each subsequent call handles less of the same string, starting further to the right.
-
         According to the specifications, a string is:
         "A sequence of non-null ASCII characters followed by a null,
         followed by 0-3 additional null characters to make the total number
@@ -106,33 +109,17 @@ class _IncomingMessage(object):
         Raises:
         ValueError if the datagram could not be parsed.
         """
-        #First test for empty string, which is nothing, followed by a terminating \x00 padded by three additional \x00.
-        if dgram[start_index:].startswith(b"\x00\x00\x00\x00"):
-            return "", start_index + 4
-
-        #Otherwise we have a non-empty string that must follow the rules of the docstring.
-
-        offset = 0
+        end = dgram.find(b"\x00", start_index)
+        if end < 0:
+            raise ValueError('Datagram is too short')
+        length = end - start_index
+        next_index = start_index + length + self.LENGTH - (length % self.LENGTH) #at least one null, padded to a word
+        if next_index > len(dgram):
+            raise ValueError('Datagram is too short')
         try:
-            while dgram[start_index + offset] != 0:
-                offset += 1
-            if offset == 0:
-                raise ValueError('OSC string cannot begin with a null byte: %s' % dgram[start_index:])
-            # Align to a byte word.
-            if (offset) % self.LENGTH == 0:
-                offset += self.LENGTH
-            else:
-                offset += (-offset % self.LENGTH)
-            # Python slices do not raise an IndexError past the last index,
-                # do it ourselves.
-            if offset > len(dgram[start_index:]):
-                raise ValueError('Datagram is too short')
-            data_str = dgram[start_index:start_index + offset]
-            return data_str.replace(b'\x00', b'').decode('utf-8'), start_index + offset
-        except IndexError as ie:
-            raise ValueError('Could not parse datagram %s' % ie)
-        except TypeError as te:
-            raise ValueError('Could not parse datagram %s' % te)
+            return dgram[start_index:end].decode('utf-8'), next_index
+        except UnicodeDecodeError as e:
+            raise ValueError('Could not parse datagram %s' % e)
 
     def get_float(self, dgram, start_index):
         """Get a 32-bit big-endian IEEE 754 floating point number from the datagram.
@@ -148,44 +135,86 @@ class _IncomingMessage(object):
             ValueError if the datagram could not be parsed.
         """
         try:
-            return (struct.unpack('>f', dgram[start_index:start_index + self.LENGTH])[0], start_index + self.LENGTH)
-        except (struct.error, TypeError) as e:
+            return self._FLOAT.unpack_from(dgram, start_index)[0], start_index + self.LENGTH
+        except struct.error as e:
+            raise ValueError('Could not parse datagram %s' % e)
+
+    def get_long(self, dgram, start_index):
+        """Get a 64-bit big-endian two's complement integer (type h) from the datagram."""
+        try:
+            return self._LONG.unpack_from(dgram, start_index)[0], start_index + 2 * self.LENGTH
+        except struct.error as e:
             raise ValueError('Could not parse datagram %s' % e)
 
+    def get_double(self, dgram, start_index):
+        """Get a 64-bit big-endian IEEE 754 floating point number (type d) from the datagram."""
+        try:
+            return self._DOUBLE.unpack_from(dgram, start_index)[0], start_index + 2 * self.LENGTH
+        except struct.error as e:
+            raise ValueError('Could not parse datagram %s' % e)
+
+    def get_blob(self, dgram, start_index):
+        """Get a blob (type b) from the datagram: an int32 size followed by that many bytes,
+        padded to a multiple of 32 bits."""
+        size, start_index = self.get_int(dgram, start_index)
+        end = start_index + size
+        if size < 0 or end > len(dgram):
+            raise ValueError('Datagram is too short')
+        return bytes(dgram[start_index:end]), end + (-size % self.LENGTH)
+
     def parse_datagram(self):
+        """Parse the address and type tags. Arguments are parsed by _parse_arguments when needed."""
         try:
             self._address_regexp, index = self.get_string(self._dgram, 0)
-            if not self._dgram[index:]:
+            if index >= len(self._dgram):
                 # No params is legit, just return now.
+                self._parameters = []
                 return
 
             # Get the parameters types.
             type_tag, index = self.get_string(self._dgram, index)
             if type_tag.startswith(','):
                 type_tag = type_tag[1:]
+            self._typeTags = type_tag
+            self._argumentsIndex = index
+        except ValueError as pe:
+            #raise ValueError('Found incorrect datagram, ignoring it', pe)
+            # Raising an error is not ignoring it!
+            logger.warning("Found incorrect datagram, ignoring it. {}".format(pe))
+            self._parameters = []
 
+    def _parse_arguments(self):
+        parameters = []
+        index = self._argumentsIndex
+        dgram = self._dgram
+        try:
             # Parse each parameter given its type.
-            for param in type_tag:
-                if param == "i":  # Integer.
-                    val, index = self.get_int(self._dgram, index)
-                elif param == "f":  # Float.
-                    val, index = self.get_float(self._dgram, index)
-                elif param == "s":  # String.
-                    val, index = self.get_string(self._dgram, index)
+            for param in self._typeTags:
+                if param in self._CONSTANTS:
+                    val = self._CONSTANTS[param]
+                elif param in self._GETTERS:
+                    val, index = self._GETTERS[param](self, dgram, index)
                 else:
                     logger.warning("Unhandled parameter type: {0}".format(param))
                     continue
-                self._parameters.append(val)
+                parameters.append(val)
         except ValueError as pe:
-            #raise ValueError('Found incorrect datagram, ignoring it', pe)
-            # Raising an error is not ignoring it!
             logger.warning("Found incorrect datagram, ignoring it. {}".format(pe))
+        self._parameters = parameters
+
+    _GETTERS = {"i": get_int, "f": get_float, "s": get_string, "S": get_string,
+                "h": get_long, "d": get_double, "b": get_blob}
 
     @property
     def oscpath(self):
         """Returns the OSC address regular expression."""
         return self._address_regexp
 
+    @property
+    def typetags(self):
+        """Returns the type tags of the arguments, without the leading comma. Does not decode them."""
+        return self._typeTags
+
     @staticmethod
     def dgram_is_message(dgram):
         """Returns whether this datagram starts as an OSC message."""
@@ -208,8 +237,314 @@ class _IncomingMessage(object):
 
     def __iter__(self):
         """Returns an iterator over the parameters of this message."""
+        if self._parameters is None:
+            self._parse_arguments()
         return iter(self._parameters)
 
+_NTP_EPOCH = 2208988800 #seconds from 1900, the OSC time origin, to 1970
+_TIMETAG = struct.Struct('>II')
+_IMMEDIATELY = (0, 1)
+
+def _timetagToTime(seconds, fraction):
+    """Unix time of an OSC timetag, None for 'immediately'."""
+    if (seconds, fraction) == _IMMEDIATELY:
+        return None
+    return seconds - _NTP_EPOCH + fraction / 2**32
+
+def _timeToTimetag(when):
+    """OSC timetag of a unix time, None meaning 'immediately'."""
+    if when is None:
+        return _IMMEDIATELY
+    seconds = int(when)
+    return seconds + _NTP_EPOCH, int((when - seconds) * 2**32) & 0xffffffff
+
+class _IncomingBundle(object):
+    """Representation of a parsed datagram representing an OSC bundle:
+    "#bundle", a timetag, then elements prefixed by their int32 size.
+    Elements are messages or bundles themselves."""
+
+    HEADER = b"#bundle\x00"
+    MAX_DEPTH = 8 #nested bundles
+
+    def __init__(self, dgram, depth=0):
+        if not dgram.startswith(self.HEADER) or len(dgram) < 16:
+            raise ValueError("Not a bundle")
+        if depth > self.MAX_DEPTH:
+            raise ValueError("Bundles nested too deep")
+        self.timetag = _timetagToTime(*_TIMETAG.unpack_from(dgram, 8)) #unix time, None is immediately
+        self.elements = []
+        index = 16
+        while index < len(dgram):
+            if index + 4 > len(dgram):
+                raise ValueError("Bundle element size is truncated")
+            size = struct.unpack_from('>i', dgram, index)[0]
+            index += 4
+            if size <= 0 or size % 4 or index + size > len(dgram):
+                raise ValueError("Bad bundle element size {}".format(size))
+            element = dgram[index:index + size]
+            if element.startswith(self.HEADER):
+                self.elements.append(_IncomingBundle(element, depth + 1))
+            else:
+                self.elements.append(_IncomingMessage(element))
+            index += size
+
+    @staticmethod
+    def dgram_is_bundle(dgram):
+        return dgram.startswith(_IncomingBundle.HEADER)
+
+    def messages(self):
+        """Yields (timetag, message) for every message, nested bundles included.
+        Messages of a nested bundle get its own timetag, if any."""
+        for element in self.elements:
+            if isinstance(element, _IncomingBundle):
+                for timetag, message in element.messages():
+                    yield (timetag if timetag is not None else self.timetag), message
+            else:
+                yield self.timetag, element
+
+def _typeTag(value):
+    """OSC type tag of a python value."""
+    if value is True:
+        return "T"
+    if value is False:
+        return "F"
+    if value is None:
+        return "N"
+    if isinstance(value, int):
+        return "i" if -0x80000000 <= value <= 0x7fffffff else "h"
+    return _TYPETAGS[type(value)]
+
+_TYPETAGS = {str: "s", float: "f", bytes: "b", bytearray: "b"}
+
+class _MessageTemplate(object):
+    """The compiled form of an outgoing message: its address and type tags are encoded once
+    per (path, signature), arguments are then packed into a caller's buffer with pack_into.
+    Get them through compileMessage, which caches them."""
+
+    LENGTH = 4 #32 bit
+    _INT = struct.Struct('>i')
+    _FLOAT = struct.Struct('>f')
+    _LONG = struct.Struct('>q')
+    _DOUBLE = struct.Struct('>d')
+
+    def __init__(self, oscpath, signature):
+        self.oscpath = oscpath
+        self.signature = signature
+        self.prefix = _MessageTemplate.encodeString(oscpath) + _MessageTemplate.encodeString("," + signature)
+
+    @staticmethod
+    def encodeString(val):
+        dgram = val.encode('utf-8')
+        return dgram + b'\x00' * (4 - (len(dgram) % 4))
+
+    def size(self, args):
+        """The exact datagram size for args, strings and blobs taken into account."""
+        size = len(self.prefix)
+        for tag, value in zip(self.signature, args):
+            if tag in "if":
+                size += 4
+            elif tag in "hd":
+                size += 8
+            elif tag == "s":
+                size += len(value.encode('utf-8')) + 4 - (len(value.encode('utf-8')) % 4)
+            elif tag == "b":
+                size += 4 + len(value) + (-len(value) % 4)
+        return size
+
+    def pack_into(self, buffer, args, offset=0):
+        """Write the message for args into buffer at offset. Returns the offset where it ends,
+        which is the datagram size for offset 0. Raises ValueError if the buffer is too small, see size()."""
+        if len(args) != len(self.signature):
+            raise ValueError("{} expects {} arguments, got {}".format(self.oscpath, len(self.signature), len(args)))
+        if offset + len(self.prefix) > len(buffer):
+            raise ValueError("Buffer too small")
+        buffer[offset:offset + len(self.prefix)] = self.prefix
+        offset += len(self.prefix)
+        try:
+            for tag, value in zip(self.signature, args):
+                if tag == "i":
+                    self._INT.pack_into(buffer, offset, value)
+                    offset += 4
+                elif tag == "f":
+                    self._FLOAT.pack_into(buffer, offset, value)
+                    offset += 4
+                elif tag == "h":
+                    self._LONG.pack_into(buffer, offset, value)
+                    offset += 8
+                elif tag == "d":
+                    self._DOUBLE.pack_into(buffer, offset, value)
+                    offset += 8
+                elif tag in "sb":
+                    data = value.encode('utf-8') if tag == "s" else value
+                    if tag == "b":
+                        self._INT.pack_into(buffer, offset, len(data))
+                        offset += 4
+                    padded = len(data) + ((4 - len(data) % 4) if tag == "s" else (-len(data) % 4))
+                    if offset + padded > len(buffer):
+                        raise ValueError("Buffer too small")
+                    buffer[offset:offset + len(data)] = data
+                    buffer[offset + len(data):offset + padded] = bytes(padded - len(data))
+                    offset += padded
+                #T, F and N have no data
+        except struct.error as e:
+            raise ValueError("Buffer too small or bad argument: {}".format(e))
+        return offset
+
+    def build(self, args):
+        """Returns the datagram for args as bytes."""
+        buffer = bytearray(self.size(args))
+        self.pack_into(buffer, args)
+        return bytes(buffer)
+
+_templates = {} #least recently used first
+_TEMPLATE_CACHE_SIZE = 256 #send() with paths like /sfx/param/<n> must not grow it forever
+
+def compileMessage(oscpath, signature=""):
+    """Returns the _MessageTemplate for oscpath and a type tag signature like "ss".
+    The last _TEMPLATE_CACHE_SIZE ones used are cached. Keep the template of a hot message
+    yourself instead of relying on the cache."""
+    key = (oscpath, signature)
+    template = _templates.pop(key, None)
+    if template is None:
+        template = _MessageTemplate(oscpath, signature)
+        if len(_templates) >= _TEMPLATE_CACHE_SIZE:
+            del _templates[next(iter(_templates))]
+    _templates[key] = template
+    return template
+
+_REPLY = compileMessage("/reply", "ss")
+_ERROR = compileMessage("/error", "sis")
+_PROGRESS = compileMessage("/nsm/client/progress", "f")
+
+def _patternToRegex(pattern):
+    """Translate an OSC address pattern to a regular expression:
+    * any characters, ? one character, [a-z] and [!a-z] sets, {foo,bar} alternatives.
+    None of them match across a /"""
+    result = []
+    index = 0
+    while index < len(pattern):
+        char = pattern[index]
+        if char == "*":
+            result.append("[^/]*")
+        elif char == "?":
+            result.append("[^/]")
+        elif char == "[":
+            end = pattern.index("]", index) #ValueError for an unclosed set
+            content = pattern[index+1:end]
+            negate = content.startswith("!")
+            if negate:
+                content = content[1:]
+            content = "".join(["\\" + c if c in "\\^[]" else c for c in content]) #keep - for ranges
+            result.append("[^/" + content + "]" if negate else "[" + content + "]")
+            index = end
+        elif char == "{":
+            end = pattern.index("}", index)
+            result.append("(?:" + "|".join([re.escape(word) for word in pattern[index+1:end].split(",")]) + ")")
+            index = end
+        else:
+            result.append(re.escape(char))
+        index += 1
+    return "".join(result)
+
+class _Router(dict):
+    """Reactions by OSC path. Still a dict of path:function, so nsmClient.reactions[path] = func keeps working,
+    and exact paths are found with one dict lookup.
+    Paths with OSC wildcards, e.g. reactions["/patcher/*"] = func, are patterns. They are compiled into one
+    regular expression and only tried when no exact path matches. The first registered pattern wins.
+
+    route(path, func, typetags) also declares the argument types the function accepts, e.g. "ss".
+    Messages with other types are rejected before their arguments are decoded."""
+
+    WILDCARDS = re.compile(r"[*?\[\]{}]")
+
+    def __init__(self, *args, **kwargs):
+        super().__init__()
+        self._typetags = {} #path:typetags, for paths that declared them
+        self._patterns = [] #wildcard paths, in registration order
+        self._regex = None #compiled lazily, see match
+        self.update(*args, **kwargs)
+
+    def __setitem__(self, path, func):
+        super().__setitem__(path, func)
+        self._typetags.pop(path, None)
+        if self.WILDCARDS.search(path) and not path in self._patterns:
+            self._patterns.append(path)
+            self._regex = None
+
+    def __delitem__(self, path):
+        super().__delitem__(path)
+        self._forget(path)
+
+    def _forget(self, path):
+        self._typetags.pop(path, None)
+        if path in self._patterns:
+            self._patterns.remove(path)
+            self._regex = None
+
+    #Every other dict method that adds or removes paths goes through the two above
+
+    def update(self, *args, **kwargs):
+        for path, func in dict(*args, **kwargs).items():
+            self[path] = func
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+    def setdefault(self, path, func=None):
+        if path not in self:
+            self[path] = func
+        return self[path]
+
+    def pop(self, path, *default):
+        if path not in self:
+            return super().pop(path, *default) #the default, or KeyError
+        func = self[path]
+        del self[path]
+        return func
+
+    def popitem(self):
+        path, func = super().popitem()
+        self._forget(path)
+        return path, func
+
+    def clear(self):
+        super().clear()
+        self._typetags.clear()
+        self._patterns.clear()
+        self._regex = None
+
+    def route(self, path, func=None, typetags=None):
+        """Add a reaction. Without func it is a decorator:
+            @nsmClient.reactions.route("/patcher/{connect,disconnect}", typetags="ss")
+            def patch(msg): ..."""
+        if func is None:
+            return lambda func: self.route(path, func, typetags)
+        self[path] = func
+        if typetags is not None:
+            self._typetags[path] = typetags
+        return func
+
+    def match(self, path):
+        """The registered path or pattern for path, or None"""
+        if not isinstance(path, str): #a malformed datagram has no address
+            return None
+        if path in self:
+            return path
+        if not self._patterns:
+            return None
+        if self._regex is None:
+            self._regex = re.compile("|".join(["(?P<p{}>{})".format(number, _patternToRegex(pattern)) for number, pattern in enumerate(self._patterns)]))
+        found = self._regex.fullmatch(path)
+        if found:
+            return self._patterns[int(found.lastgroup[1:])]
+        return None
+
+    def accepts(self, route, msg):
+        """Does the message have the typetags route declared, if any"""
+        typetags = self._typetags.get(route)
+        return typetags is None or typetags == msg.typetags
+
 class _OutgoingMessage(object):
     def __init__(self, oscpath):
         self.LENGTH = 4 #32 bit
@@ -217,49 +552,43 @@ class _OutgoingMessage(object):
         self._args = []
 
     def write_string(self, val):
-        dgram = val.encode('utf-8')
-        diff = self.LENGTH - (len(dgram) % self.LENGTH)
-        dgram += (b'\x00' * diff)
-        return dgram
+        return _MessageTemplate.encodeString(val)
 
     def write_int(self, val):
-        return struct.pack('>i', val)
+        return _MessageTemplate._INT.pack(val)
 
     def write_float(self, val):
-        return struct.pack('>f', val)
+        return _MessageTemplate._FLOAT.pack(val)
 
     def add_arg(self, argument):
-        t = {str:"s", int:"i", float:"f"}[type(argument)]
-        self._args.append((t, argument))
-
-    def build(self):
-        dgram = b''
-
-        #OSC Path
-        dgram += self.write_string(self.oscpath)
+        self._args.append((_typeTag(argument), argument))
 
-        if not self._args:
-            dgram += self.write_string(',')
-            return dgram
+    def template(self):
+        return compileMessage(self.oscpath, "".join([arg[0] for arg in self._args]))
 
-        # Write the parameters.
-        arg_types = "".join([arg[0] for arg in self._args])
-        dgram += self.write_string(',' + arg_types)
-        for arg_type, value in self._args:
-            f = {"s":self.write_string, "i":self.write_int, "f":self.write_float}[arg_type]
-            dgram += f(value)
-        return dgram
+    def build(self):
+        return self.template().build([arg[1] for arg in self._args])
 
 class NSMNotRunningError(Exception):
     """Error raised when environment variable $NSM_URL was not found."""
 
+class NSMHandshakeTimeoutError(Exception):
+    """Error raised when NSM did not answer our announce or did not send /nsm/client/open in time."""
+
 class NSMClient(object):
     """The representation of the host programs as NSM sees it.
     Technically consists of an udp server and a udp client.
 
     Does not run an event loop itself and depends on the host loop.
-    E.g. a Qt timer or just a simple while True: sleep(0.1) in Python."""
-    def __init__(self, prettyName, supportsSaveStatus, saveCallback, openOrNewCallback, exitProgramCallback, hideGUICallback=None, showGUICallback=None, broadcastCallback=None, sessionIsLoadedCallback=None, loggingLevel = "info"):
+    The client has a fileno(), so it can be registered in any selector or event loop
+    and only be woken up when a datagram arrives. asyncio hosts can simply call
+    addToAsyncioLoop(). Hosts without a loop of their own can call waitAndReact() in a loop.
+    Polling reactToMessage from a timer, e.g. a Qt timer or a while True: sleep(0.1),
+    still works but adds up to one poll period of latency to every message."""
+    MAX_DATAGRAM = 65536 #bigger than any udp payload, so nothing gets truncated in practice
+    SO_RXQ_OVFL = getattr(socket, "SO_RXQ_OVFL", 40) #linux/socket.h, not exported by all Pythons
+
+    def __init__(self, prettyName, supportsSaveStatus, saveCallback, openOrNewCallback, exitProgramCallback, hideGUICallback=None, showGUICallback=None, broadcastCallback=None, sessionIsLoadedCallback=None, loggingLevel = "info", drainBudget = 256, receiveBufferSize = None, blockingHandshake = True, handshakeTimeout = 10.0, announceInterval = 1.0, saveExecutor = None, metrics = None):
 
         self.nsmOSCUrl = self.getNsmOSCUrl() #this fails and raises NSMNotRunningError if NSM is not available. Host programs can ignore it or exit their program.
 
@@ -288,17 +617,36 @@ class NSMClient(object):
         self.hideGUICallback = hideGUICallback
         self.showGUICallback = showGUICallback
         self.sessionIsLoadedCallback = sessionIsLoadedCallback
+        self.drainBudget = drainBudget #max. messages handled per wakeup. None means no limit.
+        self.receiveBufferSize = receiveBufferSize #socket SO_RCVBUF in bytes. None keeps the system default.
+        self.handshakeTimeout = handshakeTimeout #seconds until NSMHandshakeTimeoutError
+        self.announceInterval = announceInterval #seconds between announces while NSM does not reply
+        if saveExecutor is True:
+            from concurrent.futures import ThreadPoolExecutor
+            saveExecutor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="nsm-save")
+        self.saveExecutor = saveExecutor #if set, saveCallback runs there and we advertise :progress:, see _saveCallback
+        self._saving = None #Future of the running save
+        self._savingStarted = None
+        self._dirtied = 0 #how often the host announced a dirty state. A background save started at another count is not clean when done
+        self._dirtiedAtSave = 0
+        self._saveStatusLock = threading.Lock() #announceSaveStatus runs in the host thread, _saveDone in the save thread
+        self.metrics = metrics #an sfxmetrics.Metrics, optional. Counts messages and times reactions, answers /sfx/metrics
+        self._lastSender = None #address of the last datagram received
 
         #Reactions get the raw _IncomingMessage OSC object
         #A client can add to reactions.
-        self.reactions = {
+        self.reactions = _Router({
                           "/nsm/client/save" : self._saveCallback,
                           "/nsm/client/show_optional_gui" : lambda msg: self.showGUICallback(),
                           "/nsm/client/hide_optional_gui" : lambda msg: self.hideGUICallback(),
                           "/nsm/client/session_is_loaded" : self._sessionIsLoadedCallback,
+                          "/reply" : self._replyReaction,
+                          "/error" : self._errorReaction,
+                          "/sfx/metrics" : self._metricsReaction,
                           #Hello source-code reader. You can add your own reactions here by nsmClient.reactions[oscpath]=func, where func gets the raw _IncomingMessage OSC object as argument.
+                          #oscpath can be an OSC pattern like "/patcher/*". See _Router.route to declare typetags as well.
                           #broadcast is handled directly by the function because it has more parameters
-                          }
+                          })
         #self.discardReactions = set(["/nsm/client/session_is_loaded"])
         self.discardReactions = set()
 
@@ -307,6 +655,26 @@ class NSMClient(object):
         self.sock.bind(('', 0)) #pick a free port on localhost.
         ip, port = self.sock.getsockname()
         self.ourOscUrl = f"osc.udp://{ip}:{port}/"
+        if receiveBufferSize:
+            #Room for bursts of broadcasts between two wakeups. Linux doubles the value and caps it at net.core.rmem_max.
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, receiveBufferSize)
+        self._dropCounter = platform.startswith("linux") #kernel reports datagrams dropped for a full receive buffer
+        if self._dropCounter:
+            try:
+                self.sock.setsockopt(socket.SOL_SOCKET, self.SO_RXQ_OVFL, 1)
+            except OSError:
+                self._dropCounter = False
+        self._receiveBuffer = bytearray(self.MAX_DATAGRAM) #reused by every receive
+        self._ancillarySize = socket.CMSG_SPACE(4) if self._dropCounter else 0
+        self.receivedCount = 0
+        self.truncatedCount = 0 #datagrams bigger than MAX_DATAGRAM, ignored
+        self.droppedCount = 0 #datagrams the kernel dropped before we could read them. Linux only.
+        self._sendBuffer = bytearray(4096) #reused by every sendCompiled
+        self._sendLock = threading.Lock() #the buffer is shared with the save thread, see saveExecutor
+        self._scheduled = [] #heap of (unix time, sequence, message) for bundles with a timetag in the future
+        self._scheduledCount = 0
+        self._selector = None #created by waitAndReact
+        self._asyncioLoop = None #set by addToAsyncioLoop
 
         self.executableName = self.getExecutableName()
 
@@ -323,61 +691,373 @@ class NSMClient(object):
         self.isVisible = None #set in announceGuiVisibility
         self.saveStatus = True # true is clean. false means we need saving.
 
+        #Handshake state, see announceOurselves
+        self._handshake = None #"announce" until /reply, then "open" until /nsm/client/open, None when done.
+        self._handshakeDeadline = None
+        self._announceData = None
+        self._nextAnnounce = None
+        self._deferred = [] #unrelated messages received during the handshake
+        self._replay = [] #deferred messages, handled by the next reactToMessages
+
+        #We never block on the socket, the handshake waits with a deadline instead.
+        #We expect sock.recvfrom to be empty in 99.99...% of the time so we shouldn't wait for the answer.
+        self.sock.setblocking(False)
         self.announceOurselves()
+        if blockingHandshake:
+            self.waitForHandshake()
+        #Otherwise the constructor returns right away and the handshake runs in the host's event loop,
+        #while the host does its own initialization. openOrNewCallback is called once NSM sends /nsm/client/open.
+        #Either way, after this point the host must include self.reactToMessage in its event loop
 
-        assert self.serverFeatures, self.serverFeatures
-        assert self.sessionName, self.sessionName
-        assert self.ourPath, self.ourPath
-        assert self.ourClientNameUnderNSM, self.ourClientNameUnderNSM
 
-        self.sock.setblocking(False) #We have waited for tha handshake. Now switch blocking off because we expect sock.recvfrom to be empty in 99.99...% of the time so we shouldn't wait for the answer.
-        #After this point the host must include self.reactToMessage in its event loop
+    @property
+    def handshakeComplete(self):
+        """True once NSM has opened us, see announceOurselves"""
+        return self._handshake is None
+
+    def waitForHandshake(self):
+        """Block until the handshake is complete. Raises NSMHandshakeTimeoutError.
+        This is what the constructor does unless blockingHandshake=False."""
+        while self._handshake:
+            self.waitAndReact(self._handshakeDelay())
+
+    def _handshakeDelay(self):
+        """Seconds until the next announce retransmit or the deadline, None if we are not in a handshake."""
+        if not self._handshake:
+            return None
+        due = self._handshakeDeadline
+        if self._handshake == "announce":
+            due = min(due, self._nextAnnounce)
+        return max(due - time.time(), 0)
+
+    def _handshakeTimers(self):
+        now = time.time()
+        if now >= self._handshakeDeadline:
+            state = self._handshake
+            self._handshake = "failed" #no more timers, messages are deferred forever
+            if state == "announce":
+                raise NSMHandshakeTimeoutError("NSM did not reply to our announce within {} seconds".format(self.handshakeTimeout))
+            raise NSMHandshakeTimeoutError("NSM did not send /nsm/client/open within {} seconds".format(self.handshakeTimeout))
+        if self._handshake == "announce" and now >= self._nextAnnounce:
+            logger.info("No reply from NSM yet. Sending our announce again")
+            self.sock.sendto(self._announceData, self.nsmOSCUrl)
+            self._nextAnnounce = now + self.announceInterval
+
+    def _handshakeMessage(self, msg):
+        """React to a message while the handshake is running. Anything that is not the next step is deferred."""
+        if self._handshake == "announce" and msg.oscpath in ("/reply", "/error") and msg.params and msg.params[0] == "/nsm/server/announce":
+            if msg.oscpath == "/error":
+                originalMessage, errorCode, reason = msg.params
+                logger.error("Code {}: {}".format(errorCode, reason))
+                quit()
+            nsmAnnouncePath, welcomeMessage, managerName, self.serverFeatures = msg.params
+            logger.info("Got /reply " + welcomeMessage)
+            if self.metrics:
+                self.metrics.reply("/nsm/server/announce")
+            self._handshake = "open" #Wait for /nsm/client/open
 
-        #We assume we are save at startup.
-        self.announceSaveStatus(isClean = True)
+        elif self._handshake == "open" and msg.oscpath == "/nsm/client/open":
+            self.ourPath, self.sessionName, self.ourClientNameUnderNSM = msg.params
+            self.ourClientId = os.path.splitext(self.ourClientNameUnderNSM)[1][1:]
+            logger.info("Got '/nsm/client/open' from NSM. Telling our client to load or create a file with name {}".format(self.ourPath))
+            self.openOrNewCallback(self.ourPath, self.sessionName, self.ourClientNameUnderNSM) #Host function to either load an existing session or create a new one.
+            logger.info("Our client should be done loading or creating the file {}".format(self.ourPath))
+            self.sendCompiled(_REPLY, ["/nsm/client/open", "{} is opened or created".format(self.prettyName)])
+            self._handshake = None
+            self._replay, self._deferred = self._deferred, []
+
+            #We assume we are save at startup.
+            self.announceSaveStatus(isClean = True)
+            logger.info("NSMClient client init complete. Going into listening mode.")
+            if self._asyncioLoop and self._replay:
+                self._asyncioLoop.call_soon(self._drainMessages)
 
-        logger.info("NSMClient client init complete. Going into listening mode.")
+        elif msg.oscpath == "/reply" and msg.params and msg.params[0] == "/nsm/server/announce":
+            pass #answer to a retransmitted announce
 
+        else:
+            self._deferred.append(msg)
 
     def reactToMessage(self):
         """This is the main loop message. It is added to the clients event loop."""
+        if self._handshake or self._replay:
+            return self.reactToMessages(1)
         try:
-            data, addr = self.sock.recvfrom(4096) #4096 is quite big. We don't expect nsm messages this big. Better safe than sorry. However, messages will crash the program if they are bigger than 4096.
+            data = self._receive()
         except BlockingIOError: #happens while no data is received. Has nothing to do with blocking or not.
             return None
 
-        msg = _IncomingMessage(data)
-        if msg.oscpath in self.reactions:
-            self.reactions[msg.oscpath](msg)
+        if data:
+            self._reactToDatagram(data)
+
+    def _receive(self):
+        """Read one datagram into our preallocated buffer and return a copy of it,
+        the parsed messages keep a reference. Returns None for a truncated datagram.
+        Raises BlockingIOError if there is nothing to read."""
+        size, ancillary, flags, addr = self.sock.recvmsg_into([self._receiveBuffer], self._ancillarySize)
+        self._lastSender = addr
+        for level, kind, value in ancillary:
+            if level == socket.SOL_SOCKET and kind == self.SO_RXQ_OVFL and len(value) >= 4:
+                dropped = struct.unpack("=I", value[:4])[0] #total since the socket was created
+                if dropped > self.droppedCount:
+                    logger.warning("{} incoming messages were dropped, the receive buffer was full. Consider a bigger receiveBufferSize.".format(dropped - self.droppedCount))
+                    self.droppedCount = dropped
+        if flags & socket.MSG_TRUNC:
+            self.truncatedCount += 1
+            logger.warning("Ignoring an incoming message bigger than {} bytes".format(self.MAX_DATAGRAM))
+            return None
+        self.receivedCount += 1
+        return bytes(memoryview(self._receiveBuffer)[:size])
+
+    def receiveStatistics(self):
+        """Counters of the receiving side, to see if messages get lost under load.
+        dropped stays 0 where the system can not tell."""
+        return {
+            "received": self.receivedCount,
+            "truncated": self.truncatedCount,
+            "dropped": self.droppedCount,
+            "receiveBufferSize": self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF),
+        }
+
+    def fileno(self):
+        """The file descriptor of our socket. It becomes readable when a message arrives.
+        This allows to register the client itself in a selector or event loop."""
+        return self.sock.fileno()
+
+    def reactToMessages(self, budget=None):
+        """Batch version of reactToMessage: react to every message waiting in the socket,
+        but to no more than budget messages if given, so a message storm can not starve the host.
+        Returns the number of messages handled. Hosts polling from a timer can use it to adapt
+        their poll rate: budget reached means more messages are probably waiting.
+
+        Python has no recvmmsg, each datagram is still one receive. But they are all read in
+        one go instead of one per poll period."""
+        count = 0
+        while self._replay and (budget is None or count < budget): #messages that arrived during the handshake come first
+            self._dispatch(self._replay.pop(0))
+            count += 1
+        if self._replay:
+            return count
+        count += self.dispatchScheduled()
+        drained = False
+        while budget is None or count < budget:
+            try:
+                data = self._receive()
+            except BlockingIOError: #nothing left
+                drained = True
+                break
+            handshake = self._handshake
+            if data:
+                self._reactToDatagram(data)
+            count += 1
+            if handshake and not self._handshake: #deferred messages are older than what is still waiting in the socket
+                break
+        if drained and self._handshake and self._handshake != "failed":
+            #Only now: what was waiting may be the answer, if the host took a while before polling
+            self._handshakeTimers()
+        return count
+
+    def dispatchScheduled(self):
+        """React to the messages of received bundles whose timetag has come. Returns how many.
+        Called by reactToMessages and the event loop integrations. Hosts polling
+        reactToMessage on their own should call it as well, see nextScheduledDelay."""
+        count = 0
+        now = time.time()
+        while self._scheduled and self._scheduled[0][0] <= now:
+            when, sequence, msg = heapq.heappop(self._scheduled)
+            self._dispatch(msg)
+            count += 1
+        return count
+
+    def nextScheduledDelay(self):
+        """Seconds until the next scheduled message is due, None if nothing is scheduled."""
+        if not self._scheduled:
+            return None
+        return max(self._scheduled[0][0] - time.time(), 0)
+
+    def _drainMessages(self):
+        """Called by the event loop when our socket is readable.
+        Messages beyond the budget are left in the socket, which stays readable,
+        so the loop calls us again after serving others."""
+        return self.reactToMessages(self.drainBudget)
+
+    def waitAndReact(self, timeout=None):
+        """Sleep until a message arrives or timeout seconds have passed, then react to all
+        pending messages. For hosts without an event loop of their own:
+            while True: nsmClient.waitAndReact()
+        wakes up only when there is something to do. timeout=None waits forever.
+        Returns the number of messages handled."""
+        if not self._selector:
+            self._selector = selectors.DefaultSelector()
+            self._selector.register(self.sock, selectors.EVENT_READ)
+        if self._replay:
+            return self._drainMessages()
+        for delay in (self.nextScheduledDelay(), self._handshakeDelay()):
+            if delay is not None and (timeout is None or delay < timeout):
+                timeout = delay
+        if self._selector.select(timeout):
+            return self._drainMessages()
+        return self._drainMessages() #only timers are due: scheduled bundles and the handshake
+
+    def addToAsyncioLoop(self, loop=None):
+        """Let an asyncio loop call us whenever a message arrives, instead of polling.
+        loop defaults to the running loop."""
+        import asyncio #only asyncio hosts pay for the import
+        self._asyncioLoop = loop or asyncio.get_running_loop()
+        self._asyncioLoop.add_reader(self.sock, self._drainMessages)
+        if self._handshake:
+            self._asyncioLoop.call_later(self._handshakeDelay(), self._asyncioHandshakeTimer)
+
+    def _asyncioHandshakeTimer(self):
+        if self._asyncioLoop and self._handshake and self._handshake != "failed":
+            self._drainMessages() #runs the timers once the socket is read. An exception here goes to the loop's exception handler
+            self._asyncioLoop.call_later(self._handshakeDelay(), self._asyncioHandshakeTimer)
+
+    def removeFromAsyncioLoop(self):
+        if self._asyncioLoop:
+            self._asyncioLoop.remove_reader(self.sock)
+            self._asyncioLoop = None
+
+    def _reactToDatagram(self, data):
+        """Counted in the metrics here, once, as received. _dispatch also runs later for
+        messages deferred during the handshake and for scheduled bundle content."""
+        if not _IncomingBundle.dgram_is_bundle(data):
+            msg = _IncomingMessage(data)
+            if self.metrics:
+                self.metrics.receive(msg.oscpath, len(data))
+            self._dispatch(msg)
+            return
+
+        try:
+            bundle = _IncomingBundle(data)
+        except (ValueError, struct.error) as e:
+            logger.warning("Found incorrect bundle, ignoring it. {}".format(e))
+            return
+        now = time.time()
+        for when, msg in bundle.messages():
+            msg.isBroadcast = True
+            if self.metrics:
+                self.metrics.receive(msg.oscpath, len(msg.dgram))
+            if when is None or when <= now:
+                self._dispatch(msg)
+            else:
+                self._schedule(when, msg)
+
+    def _schedule(self, when, msg):
+        heapq.heappush(self._scheduled, (when, self._scheduledCount, msg))
+        self._scheduledCount += 1 #keeps messages with the same timetag in order
+        if self._asyncioLoop:
+            self._asyncioLoop.call_later(max(when - time.time(), 0), self.dispatchScheduled)
+
+    def _dispatch(self, msg):
+        if self._handshake:
+            self._handshakeMessage(msg)
+            return
+        route = self.reactions.match(msg.oscpath)
+        if route is not None:
+            if not self.reactions.accepts(route, msg):
+                logger.warning("Ignoring {} with typetags '{}', {} expects '{}'".format(msg.oscpath, msg.typetags, route, self.reactions._typetags[route]))
+            elif self.metrics:
+                self.metrics.wrap(msg.oscpath, self.reactions[route])(msg)
+            else:
+                self.reactions[route](msg)
         elif msg.oscpath in self.discardReactions:
             pass
-        elif msg.oscpath == "/reply" and msg.params == ["/nsm/server/open", "Loaded."]: #NSM sends that all programs of the session were loaded.
+        elif msg.isBroadcast:
+            self._broadcastReaction(msg)
+        else:
+            logger.warning("Reaction not implemented:. Path: {} , Parameter: {}".format(msg.oscpath, msg.params))
+
+    def _broadcastReaction(self, msg):
+        if self.broadcastCallback:
+            logger.info (f"Got broadcast with messagePath {msg.oscpath} and listOfArguments {msg.params}")
+            self.broadcastCallback(self.ourPath, self.sessionName, self.ourClientNameUnderNSM, msg.oscpath, msg.params)
+        else:
+            logger.info (f"No callback for broadcast! Got messagePath {msg.oscpath} and listOfArguments {msg.params}")
+
+    def _replyReaction(self, msg):
+        if msg.typetags == "ss" and msg.params == ["/nsm/server/open", "Loaded."]: #NSM sends that all programs of the session were loaded.
             logger.info ("Got /reply Loaded from NSM Server")
-        elif msg.oscpath == "/reply" and msg.params == ["/nsm/server/save", "Saved."]: #NSM sends that all program-states are saved. Does only happen from the general save instruction, not when saving our client individually
+        elif msg.typetags == "ss" and msg.params == ["/nsm/server/save", "Saved."]: #NSM sends that all program-states are saved. Does only happen from the general save instruction, not when saving our client individually
             logger.info ("Got /reply Saved from NSM Server")
         elif msg.isBroadcast:
-            if self.broadcastCallback:
-                logger.info (f"Got broadcast with messagePath {msg.oscpath} and listOfArguments {msg.params}")
-                self.broadcastCallback(self.ourPath, self.sessionName, self.ourClientNameUnderNSM, msg.oscpath, msg.params)
-            else:
-                logger.info (f"No callback for broadcast! Got messagePath {msg.oscpath} and listOfArguments {msg.params}")
-        elif msg.oscpath == "/error":
-            logger.warning("Got /error from NSM Server. Path: {} , Parameter: {}".format(msg.oscpath, msg.params))
+            self._broadcastReaction(msg)
         else:
             logger.warning("Reaction not implemented:. Path: {} , Parameter: {}".format(msg.oscpath, msg.params))
 
+    def _errorReaction(self, msg):
+        if msg.isBroadcast:
+            self._broadcastReaction(msg)
+        else:
+            logger.warning("Got /error from NSM Server. Path: {} , Parameter: {}".format(msg.oscpath, msg.params))
+
 
     def send(self, path:str, listOfParameters:list, host=None, port=None):
         """Send any osc message. Defaults to nsmd URL.
         Will not wait for an answer but return None."""
+        signature = "".join([_typeTag(arg) for arg in listOfParameters]) #type is auto-determined
+        self.sendCompiled(compileMessage(path, signature), listOfParameters, host, port)
+
+    def sendCompiled(self, template, arguments, host=None, port=None):
+        """Send a message compiled once with compileMessage(path, signature), e.g. for high rate senders:
+            paramMessage = compileMessage("/sfx/param", "if")
+            nsmClient.sendCompiled(paramMessage, [3, 0.5])
+        Arguments are packed straight into one preallocated buffer, no bytes are built in between.
+        Defaults to nsmd URL. Will not wait for an answer but return None."""
+        if host and port:
+            url = (host, port)
+        else:
+            url = self.nsmOSCUrl
+        with self._sendLock:
+            try:
+                size = template.pack_into(self._sendBuffer, arguments)
+            except ValueError:
+                needed = template.size(arguments)
+                if needed <= len(self._sendBuffer): #the arguments are wrong, not the buffer
+                    raise
+                self._sendBuffer = bytearray(max(needed, 2 * len(self._sendBuffer)))
+                size = template.pack_into(self._sendBuffer, arguments)
+            self.sock.sendto(memoryview(self._sendBuffer)[:size], url)
+            if self.metrics:
+                self.metrics.send(template.oscpath, size)
+
+    def sendBundle(self, messages, when=None, host=None, port=None):
+        """Send several messages in one datagram, as an OSC bundle.
+        messages is a list of (path, listOfParameters) or (compiled template, listOfParameters).
+        when is the unix time the receiver should act on them, None for immediately.
+        Defaults to nsmd URL. Will not wait for an answer but return None."""
         if host and port:
             url = (host, port)
         else:
             url = self.nsmOSCUrl
-        msg = _OutgoingMessage(path)
-        for arg in listOfParameters:
-            msg.add_arg(arg) #type is auto-determined by outgoing message
-        self.sock.sendto(msg.build(), url)
+        compiled = []
+        for message, arguments in messages:
+            if not isinstance(message, _MessageTemplate):
+                message = compileMessage(message, "".join([_typeTag(arg) for arg in arguments]))
+            compiled.append((message, arguments))
+
+        with self._sendLock:
+            while True:
+                buffer = self._sendBuffer
+                try:
+                    if len(buffer) < 16:
+                        raise ValueError("Buffer too small")
+                    buffer[:8] = _IncomingBundle.HEADER
+                    _TIMETAG.pack_into(buffer, 8, *_timeToTimetag(when))
+                    offset = 16
+                    for message, arguments in compiled:
+                        end = message.pack_into(buffer, arguments, offset + 4)
+                        struct.pack_into('>i', buffer, offset, end - offset - 4)
+                        offset = end
+                    break
+                except (ValueError, struct.error): #too small, grow. Raises if the arguments are wrong.
+                    needed = 16 + sum([4 + message.size(arguments) for message, arguments in compiled])
+                    if needed <= len(buffer):
+                        raise
+                    self._sendBuffer = bytearray(max(needed, 2 * len(buffer)))
+            self.sock.sendto(memoryview(self._sendBuffer)[:offset], url)
+            if self.metrics:
+                self.metrics.send("#bundle", offset)
 
     def getNsmOSCUrl(self):
         """Return and save the nsm osc url or raise an error"""
@@ -416,6 +1096,8 @@ class NSMClient(object):
                 result.append("dirty")
             if self.hideGUICallback and self.showGUICallback:
                 result.append("optional-gui")
+            if self.saveExecutor:
+                result.append("progress")
             if result:
                 return ":".join([""] + result + [""])
             else:
@@ -433,67 +1115,96 @@ class NSMClient(object):
         hostname, port = self.nsmOSCUrl
         assert hostname, self.nsmOSCUrl
         assert port, self.nsmOSCUrl
-        self.sock.sendto(announce.build(), self.nsmOSCUrl)
-
-        #Wait for /reply (aka 'Howdy, what took you so long?)
-        data, addr = self.sock.recvfrom(1024)
-        msg = _IncomingMessage(data)
-
-        if msg.oscpath == "/error":
-            originalMessage, errorCode, reason = msg.params
-            logger.error("Code {}: {}".format(errorCode, reason))
-            quit()
-
-        elif msg.oscpath == "/reply":
-            nsmAnnouncePath, welcomeMessage, managerName, self.serverFeatures = msg.params
-            assert nsmAnnouncePath == "/nsm/server/announce", nsmAnnouncePath
-            logger.info("Got /reply " + welcomeMessage)
-
-            #Wait for /nsm/client/open
-            data, addr = self.sock.recvfrom(1024)
-            msg = _IncomingMessage(data)
-            assert msg.oscpath == "/nsm/client/open", msg.oscpath
-            self.ourPath, self.sessionName, self.ourClientNameUnderNSM = msg.params
-            self.ourClientId = os.path.splitext(self.ourClientNameUnderNSM)[1][1:]
-            logger.info("Got '/nsm/client/open' from NSM. Telling our client to load or create a file with name {}".format(self.ourPath))
-            self.openOrNewCallback(self.ourPath, self.sessionName, self.ourClientNameUnderNSM) #Host function to either load an existing session or create a new one.
-            logger.info("Our client should be done loading or creating the file {}".format(self.ourPath))
-            replyToOpen = _OutgoingMessage("/reply")
-            replyToOpen.add_arg("/nsm/client/open")
-            replyToOpen.add_arg("{} is opened or created".format(self.prettyName))
-            self.sock.sendto(replyToOpen.build(), self.nsmOSCUrl)
-        else:
-            raise ValueError("Unexpected message path after announce: {}".format((msg.oscpath, msg.params)))
+        self._announceData = announce.build()
+        self.sock.sendto(self._announceData, self.nsmOSCUrl)
+        if self.metrics:
+            self.metrics.request("/nsm/server/announce")
+
+        #Now wait for /reply (aka 'Howdy, what took you so long?) and then /nsm/client/open.
+        #This happens in _handshakeMessage, driven by waitForHandshake or the host's event loop.
+        #We announce again until NSM replies, in case it was not listening yet.
+        now = time.time()
+        self._handshake = "announce"
+        self._handshakeDeadline = now + self.handshakeTimeout
+        self._nextAnnounce = now + self.announceInterval
 
     def announceGuiVisibility(self, isVisible):
         message = "/nsm/client/gui_is_shown" if isVisible else "/nsm/client/gui_is_hidden"
         self.isVisible = isVisible
-        guiVisibility = _OutgoingMessage(message)
         logger.info("Telling NSM that our clients switched GUI visibility to: {}".format(message))
-        self.sock.sendto(guiVisibility.build(), self.nsmOSCUrl)
+        self.sendCompiled(compileMessage(message), [])
 
     def announceSaveStatus(self, isClean):
         """Only send to the NSM Server if there was really a change"""
         if not self.supportsSaveStatus:
             return
 
+        with self._saveStatusLock:
+            if not isClean:
+                self._dirtied += 1
+            self._sendSaveStatus(isClean)
+
+    def _sendSaveStatus(self, isClean):
+        """Caller holds _saveStatusLock"""
         if not isClean == self.cachedSaveStatus:
             message = "/nsm/client/is_clean" if isClean else "/nsm/client/is_dirty"
             self.cachedSaveStatus = isClean
-            saveStatus = _OutgoingMessage(message)
             logger.info("Telling NSM that our clients save state is now: {}".format(message))
-            self.sock.sendto(saveStatus.build(), self.nsmOSCUrl)
+            self.sendCompiled(compileMessage(message), [])
+
+    def announceProgress(self, progress):
+        """Tell NSM how far a save has come, 0.0 to 1.0. Needs saveExecutor, otherwise NSM does not know
+        we support it. Can be called from the saveCallback, which runs in the executor thread."""
+        self.sendCompiled(_PROGRESS, [float(progress)])
 
     def _saveCallback(self, msg):
+        if self.saveExecutor:
+            if self._saving:
+                logger.warning("NSM asked us to save while the last save is still running")
+                self.sendCompiled(_ERROR, ["/nsm/client/save", -1, "{} is still saving".format(self.prettyName)])
+                return
+            logger.info("Telling our client to save as {}, in the background".format(self.ourPath))
+            self._savingStarted = time.perf_counter()
+            with self._saveStatusLock:
+                self._dirtiedAtSave = self._dirtied
+            self._saving = self.saveExecutor.submit(self.saveCallback, self.ourPath, self.sessionName, self.ourClientNameUnderNSM)
+            self._saving.add_done_callback(self._saveDone)
+            return
+
         logger.info("Telling our client to save as {}".format(self.ourPath))
         self.saveCallback(self.ourPath, self.sessionName, self.ourClientNameUnderNSM)
-        replyToSave = _OutgoingMessage("/reply")
-        replyToSave.add_arg("/nsm/client/save")
-        replyToSave.add_arg("{} saved".format(self.prettyName))
-        self.sock.sendto(replyToSave.build(), self.nsmOSCUrl)
+        self.sendCompiled(_REPLY, ["/nsm/client/save", "{} saved".format(self.prettyName)])
         #it is assumed that after saving the state is clear
         self.announceSaveStatus(isClean = True)
 
+    def _saveDone(self, future):
+        """Called in the executor thread when a background save is done. Only now NSM gets its reply."""
+        self._saving = None
+        error = future.exception()
+        if self.metrics:
+            self.metrics.operation("save", time.perf_counter() - self._savingStarted, error=bool(error))
+        if error:
+            logger.error("Saving failed: {}".format(error))
+            self.sendCompiled(_ERROR, ["/nsm/client/save", -1, "{} could not save: {}".format(self.prettyName, error)])
+            return
+        self.sendCompiled(_PROGRESS, [1.0])
+        self.sendCompiled(_REPLY, ["/nsm/client/save", "{} saved".format(self.prettyName)])
+        if self.supportsSaveStatus:
+            with self._saveStatusLock:
+                if self._dirtied == self._dirtiedAtSave: #else the host changed something while we were saving
+                    self._sendSaveStatus(True)
+
+
+    def _metricsReaction(self, msg):
+        """Answer /sfx/metrics like the 5FX server: one /reply per row of our metrics, then an empty one.
+        The answer goes to whoever asked, e.g. the server forwarding /sfx/<client>/sfx/metrics."""
+        if not self.metrics or not self._lastSender:
+            return
+        host, port = self._lastSender[:2]
+        row = compileMessage("/reply", "ssssiiiffff")
+        for kind, path, count, size, errors, mean, p50, p99, maximum in self.metrics.rows():
+            self.sendCompiled(row, ["/sfx/metrics", self.metrics.component, kind, path, count, size, errors, mean, p50, p99, maximum], host, port)
+        self.sendCompiled(compileMessage("/reply", "ss"), ["/sfx/metrics", ""], host, port)
 
     def _sessionIsLoadedCallback(self, msg):
         if self.sessionIsLoadedCallback:
@@ -567,9 +1278,7 @@ class NSMClient(object):
         logger.info("instructing the NSM-Server to send Save to ourselves.")
         if "server-control" in self.serverFeatures:
             #message = _OutgoingMessage("/nsm/server/save") # "Save All" Command.
-            message = _OutgoingMessage("/nsm/gui/client/save")
-            message.add_arg("{}".format(self.ourClientId))
-            self.sock.sendto(message.build(), self.nsmOSCUrl)
+            self.sendCompiled(compileMessage("/nsm/gui/client/save", "s"), ["{}".format(self.ourClientId)])
         else:
             logger.warning("...but the NSM-Server does not support server control. Server only supports: {}".format(self.serverFeatures))
 
@@ -581,9 +1290,7 @@ class NSMClient(object):
 
         This is fine for us as clients, but you need to provide a GUI field to enter that label."""
         logger.info("Telling the NSM-Server that our label is now " + label)
-        message = _OutgoingMessage("/nsm/client/label")
-        message.add_arg(label)  #s:label
-        self.sock.sendto(message.build(), self.nsmOSCUrl)
+        self.sendCompiled(compileMessage("/nsm/client/label", "s"), [label])  #s:label
 
     def broadcast(self, path:str, arguments:list):
         """/nsm/server/broadcast s:path [arguments...]
@@ -595,11 +1302,8 @@ class NSMClient(object):
             logger.warning("Attempted broadbast starting with /nsm. Not allwoed")
         else:
             logger.info("Sending broadcast " + path + repr(arguments))
-            message = _OutgoingMessage("/nsm/server/broadcast")
-            message.add_arg(path)
-            for arg in arguments:
-                message.add_arg(arg)  #type autodetect
-            self.sock.sendto(message.build(), self.nsmOSCUrl)
+            signature = "s" + "".join([_typeTag(arg) for arg in arguments])  #type autodetect
+            self.sendCompiled(compileMessage("/nsm/server/broadcast", signature), [path] + list(arguments))
 
     def importResource(self, filePath):
         """aka. import into session
@@ -707,6 +1411,48 @@ class NullClient(object):
     def reactToMessage(self):
         pass
 
+    def announceProgress(self, progress):
+        pass
+
+    def reactToMessages(self, budget=None):
+        return 0
+
+    def waitAndReact(self, timeout=None):
+        """Nothing will ever arrive. Sleeps for timeout, forever if None, like the real client would."""
+        if timeout is None:
+            threading.Event().wait()
+        else:
+            time.sleep(timeout)
+        return 0
+
+    def fileno(self):
+        """A pipe nobody writes to, so hosts can still register us in their selector."""
+        if not hasattr(self, "_pipe"):
+            self._pipe = os.pipe()
+        return self._pipe[0]
+
+    def addToAsyncioLoop(self, loop=None):
+        pass
+
+    def removeFromAsyncioLoop(self):
+        pass
+
+    def dispatchScheduled(self):
+        return 0
+
+    def nextScheduledDelay(self):
+        return None
+
+    @property
+    def handshakeComplete(self):
+        return True
+
+    def waitForHandshake(self):
+        pass
+
+    def receiveStatistics(self):
+        return {"received": 0, "truncated": 0, "dropped": 0, "receiveBufferSize": 0}
+
     def importResource(self):
         return ""
 
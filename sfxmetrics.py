@@ -0,0 +1,235 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Message and timing metrics shared by the 5FX components: nsmclient, nsm-server and jack-patch.
+
+Each component keeps one Metrics. It counts messages and bytes per OSC path, sent and received,
+keeps histograms of handler durations and of round trip times between a request and its reply.
+Metrics.rows() is what the /sfx/metrics OSC query answers, one /reply per row.
+Metrics.dumpEvery(path, seconds) writes a JSON snapshot to a file periodically.
+
+Recording costs a dict lookup and a few additions, histograms have fixed buckets.
+"""
+
+import collections
+import threading
+import bisect
+import json
+import time
+import os
+
+class Histogram(object):
+    """Durations in seconds, in power of two buckets from 1µs to about 16s."""
+
+    BOUNDS = [1e-6 * 2**i for i in range(25)]
+
+    def __init__(self):
+        self.buckets = [0] * (len(self.BOUNDS) + 1) #the last one is everything above
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        self.buckets[bisect.bisect_left(self.BOUNDS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q quantile, max for the last bucket."""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for index, count in enumerate(self.buckets):
+            seen += count
+            if seen >= rank:
+                return min(self.BOUNDS[index], self.max) if index < len(self.BOUNDS) else self.max
+        return self.max
+
+    def asDict(self):
+        return {
+            "count": self.count,
+            "mean": self.mean(),
+            "p50": self.quantile(0.5),
+            "p99": self.quantile(0.99),
+            "max": self.max,
+            "buckets": {str(bound): count for bound, count in zip(self.BOUNDS + ["inf"], self.buckets) if count},
+        }
+
+class PathMetrics(object):
+    """Traffic of one OSC path, or one operation."""
+
+    def __init__(self):
+        self.count = 0
+        self.bytes = 0
+        self.errors = 0
+        self.duration = Histogram() #only for what was handled or timed
+
+    def asDict(self):
+        return {"count": self.count, "bytes": self.bytes, "errors": self.errors, "duration": self.duration.asDict()}
+
+class Metrics(object):
+    """Metrics of one component, e.g. Metrics("nsm-server")
+
+    received / sent: path -> PathMetrics, for messages.
+    operations: name -> PathMetrics, for anything timed that is not a message, e.g. a patch apply.
+    rtt: path -> Histogram, time from a request to its reply.
+
+    Recording is meant to happen on the thread of the component's event loop.
+    The dump thread only reads."""
+
+    def __init__(self, component):
+        self.component = component
+        self.started = time.time()
+        self.received = collections.defaultdict(PathMetrics)
+        self.sent = collections.defaultdict(PathMetrics)
+        self.operations = collections.defaultdict(PathMetrics)
+        self.rtt = collections.defaultdict(Histogram)
+        self._requests = collections.defaultdict(collections.deque) #key -> start times, oldest first
+        self._dumper = None
+
+    def receive(self, path, size):
+        metrics = self.received[path]
+        metrics.count += 1
+        metrics.bytes += size
+
+    def send(self, path, size):
+        metrics = self.sent[path]
+        metrics.count += 1
+        metrics.bytes += size
+
+    def handled(self, path, seconds, error=False):
+        """A handler for a received path ran for seconds"""
+        metrics = self.received[path]
+        metrics.duration.add(seconds)
+        if error:
+            metrics.errors += 1
+
+    def operation(self, name, seconds, error=False, size=0):
+        metrics = self.operations[name]
+        metrics.count += 1
+        metrics.bytes += size
+        metrics.duration.add(seconds)
+        if error:
+            metrics.errors += 1
+
+    def wrap(self, path, function, operation=False):
+        """function, timed as handler of path, or as the operation path if operation is set.
+        path may also be a function of the same arguments returning it, for functions handling
+        many paths. Exceptions are counted as errors and raised again."""
+        record = self.operation if operation else self.handled
+        def timed(*args, **kwargs):
+            key = path(*args, **kwargs) if callable(path) else path
+            start = time.perf_counter()
+            try:
+                result = function(*args, **kwargs)
+            except BaseException:
+                record(key, time.perf_counter() - start, True)
+                raise
+            record(key, time.perf_counter() - start)
+            return result
+        timed.__wrapped__ = function
+        return timed
+
+    def request(self, key):
+        """A request went out. key is what its reply will be matched with, e.g. its path."""
+        self._requests[key].append(time.perf_counter())
+
+    def reply(self, key):
+        """The reply for the oldest request with key came. Returns the round trip in seconds, or None."""
+        waiting = self._requests.get(key)
+        if not waiting:
+            return None
+        seconds = time.perf_counter() - waiting.popleft()
+        self.rtt[key].add(seconds)
+        return seconds
+
+    def roundTrip(self, key, seconds):
+        """Record a round trip measured elsewhere"""
+        self.rtt[key].add(seconds)
+
+    def rows(self):
+        """(kind, path, count, bytes, errors, mean ms, p50 ms, p99 ms, max ms) for everything recorded.
+        kind is "in", "out", "op" or "rtt"."""
+        result = []
+        for kind, table in (("in", self.received), ("out", self.sent), ("op", self.operations)):
+            for path, metrics in list(table.items()):
+                histogram = metrics.duration
+                result.append((kind, path, metrics.count, metrics.bytes, metrics.errors,
+                    histogram.mean() * 1000, histogram.quantile(0.5) * 1000, histogram.quantile(0.99) * 1000, histogram.max * 1000))
+        for path, histogram in list(self.rtt.items()):
+            result.append(("rtt", path, histogram.count, 0, 0,
+                histogram.mean() * 1000, histogram.quantile(0.5) * 1000, histogram.quantile(0.99) * 1000, histogram.max * 1000))
+        return result
+
+    def lines(self):
+        """rows() as text, one line each"""
+        lines = []
+        for kind, path, count, size, errors, mean, p50, p99, peak in self.rows():
+            unit = "messages, {} bytes".format(size) if kind in ("in", "out") else "times"
+            lines.append("{} {} {}: {} {}, {} errors, {:.3f}ms mean, {:.3f}ms p50, {:.3f}ms p99, {:.3f}ms max".format(
+                self.component, kind, path, count, unit, errors, mean, p50, p99, peak))
+        return lines
+
+    def snapshot(self):
+        def table(entries):
+            return {path: metrics.asDict() for path, metrics in list(entries.items())}
+        return {
+            "component": self.component,
+            "pid": os.getpid(),
+            "started": self.started,
+            "time": time.time(),
+            "received": table(self.received),
+            "sent": table(self.sent),
+            "operations": table(self.operations),
+            "rtt": {path: histogram.asDict() for path, histogram in list(self.rtt.items())},
+        }
+
+    def dump(self, path):
+        """Write snapshot() to path as JSON, through a temporary file."""
+        tmp = path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.snapshot(), f)
+        os.replace(tmp, path)
+
+    def dumpEvery(self, path, seconds):
+        """Dump to path every seconds from a daemon thread, and once more at stopDumping()."""
+        self.stopDumping()
+        stop = threading.Event()
+        def run():
+            while not stop.wait(seconds):
+                self.dump(path)
+            self.dump(path)
+        thread = threading.Thread(target=run, name="sfxmetrics-dump", daemon=True)
+        self._dumper = (thread, stop)
+        thread.start()
+
+    def stopDumping(self):
+        if self._dumper:
+            thread, stop = self._dumper
+            stop.set()
+            thread.join()
+            self._dumper = None
+
+def _padded(size):
+    return (size // 4 + 1) * 4 #OSC strings always get at least one null byte
+
+def oscSize(path, types, args):
+    """Size of the OSC message for path, typetags and arguments, for components
+    that do not see the datagram itself, e.g. liblo callbacks."""
+    size = _padded(len(path.encode())) + _padded(len(types) + 1)
+    for tag, arg in zip(types, args):
+        if tag in "ifcrm":
+            size += 4
+        elif tag in "hdt":
+            size += 8
+        elif tag in "sS":
+            size += _padded(len(arg.encode()))
+        elif tag == "b":
+            size += 4 + (len(arg) + 3) // 4 * 4
+    return size